@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""Benchmarks for Terminal Velocity on synthetic notebooks.
+
+Generates notebooks of the requested sizes in a temporary directory, times
+loading them, searching them with typical keystroke sequences and filtering
+the user interface, and writes the results to a JSON file. Pass an earlier
+results file with --compare to see how the timings have changed.
+
+    python3 benchmarks/tv_benchmark.py --sizes 1000,10000 -o after.json \\
+        --compare before.json
+
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import tv_index  # noqa: E402
+import tv_notebook  # noqa: E402
+import urwid_ui  # noqa: E402
+
+WORDS = [
+    'meeting', 'notes', 'project', 'todo', 'idea', 'python', 'terminal',
+    'velocity', 'release', 'budget', 'draft', 'review', 'travel', 'recipe',
+    'journal', 'backup', 'server', 'invoice', 'research', 'summary',
+    'café', 'naïve', 'résumé', 'Straße', 'façade', 'Ångström', '東京',
+    'München', 'señor', 'Ελληνικά', 'задача', '🎉',
+]
+
+# The queries typed one keystroke at a time, '<' is a backspace.
+KEYSTROKE_QUERIES = [
+    'meeting notes',
+    'project budget',
+    'café',
+    'Straße',
+    'todo<<<ravel',
+    'meeting notes<<<<<<',
+    'zzzz',
+]
+
+# The size of the fake screen that the user interface is rendered on.
+SCREEN_SIZE = (100, 40)
+
+
+def generate_notebook(path, count, seed=0):
+    """Write `count` synthetic notes to `path`.
+
+    Notes are spread over a nested directory tree, have sizes from a few
+    bytes to a few hundred kilobytes, and include non-ASCII text.
+
+    """
+    rng = random.Random(seed)
+    directories = ['']
+    for i in range(max(1, count // 200)):
+        parent = rng.choice(directories)
+        if parent.count(os.sep) < 3:
+            directories.append(os.path.join(parent, 'dir{}'.format(i)))
+    for directory in directories:
+        os.makedirs(os.path.join(path, directory), exist_ok=True)
+    for i in range(count):
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+        filename = '{} {}{}'.format(title, i, rng.choice(['.txt', '.md']))
+        abspath = os.path.join(path, rng.choice(directories), filename)
+        words = int(rng.lognormvariate(4.5, 1.2))
+        lines = []
+        for _ in range(0, words, 12):
+            lines.append(' '.join(rng.choice(WORDS) for _ in range(12)))
+        with open(abspath, 'w', encoding='utf-8') as fp:
+            fp.write('\n'.join(lines))
+
+
+def keystrokes(text):
+    """Return the successive queries from typing `text`, '<' deleting."""
+    queries = []
+    query = ''
+    for character in text:
+        if character == '<':
+            query = query[:-1]
+        else:
+            query += character
+        queries.append(query)
+    return queries
+
+
+def timed(function, *args, **kwargs):
+    """Return (seconds, result) for a call of function."""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def summarize(timings):
+    """Return summary statistics, in milliseconds, for a list of seconds."""
+    timings = sorted(timings)
+    return {
+        'count': len(timings),
+        'total_ms': 1000 * sum(timings),
+        'median_ms': 1000 * statistics.median(timings),
+        'p90_ms': 1000 * timings[int(0.9 * (len(timings) - 1))],
+        'max_ms': 1000 * timings[-1],
+    }
+
+
+def load_notebook(path, search_engine):
+    return tv_notebook.PlainTextNoteBook(
+        path, 'txt', ['.txt', '.md'],
+        search_function=tv_index.make_search_function(search_engine),
+        watch=False)
+
+
+def close_notebook(notebook):
+    """Stop the notebook's observer and its search function's workers."""
+    notebook.stop_watching()
+    close = getattr(notebook.search_function, 'close', None)
+    if close is not None:
+        close()
+
+
+def benchmark_search(notebook):
+    """Time notebook.search() for every keystroke of the typical queries."""
+    results = {}
+    for text in KEYSTROKE_QUERIES:
+        timings = []
+        for query in keystrokes(text):
+            seconds, _ = timed(notebook.search, query)
+            timings.append(seconds)
+        results[text] = summarize(timings)
+    return results
+
+
+def benchmark_search_function(notebook):
+    """Time brute_force_search() over the whole notebook per keystroke."""
+    results = {}
+    for text in KEYSTROKE_QUERIES:
+        timings = []
+        for query in keystrokes(text):
+            seconds, _ = timed(tv_notebook.brute_force_search, notebook, query)
+            timings.append(seconds)
+        results[text] = summarize(timings)
+    return results
+
+
+def benchmark_filter(path, search_engine):
+    """Time MainFrame.filter() and rendering for the typical queries."""
+    seconds, frame = timed(
+        urwid_ui.MainFrame, path, 'true', 'txt', ['.txt', '.md'],
+        search_engine=search_engine)
+    results = {'construct': summarize([seconds])}
+    for text in KEYSTROKE_QUERIES:
+        timings = []
+        for query in keystrokes(text):
+            start = time.perf_counter()
+            frame.filter(query)
+            frame.render(SCREEN_SIZE).content()
+            timings.append(time.perf_counter() - start)
+        results[text] = summarize(timings)
+    close_notebook(frame.tv_notebook)
+    return results
+
+
+def run(sizes, search_engines, seed=0, keep=None):
+    """Run all of the benchmarks and return the results as a dict."""
+    results = {}
+    for size in sizes:
+        path = keep or tempfile.mkdtemp(prefix='tv3-benchmark-')
+        path = os.path.join(path, str(size))
+        try:
+            if not os.path.isdir(path):
+                seconds, _ = timed(generate_notebook, path, size, seed)
+                print('Generated {} notes in {:.1f}s'.format(size, seconds),
+                      file=sys.stderr)
+            size_results = results[str(size)] = {}
+            for search_engine in search_engines:
+                seconds, notebook = timed(load_notebook, path, search_engine)
+                size_results[search_engine] = {
+                    'load': summarize([seconds]),
+                    'search': benchmark_search(notebook),
+                    'brute_force_search': benchmark_search_function(
+                        notebook),
+                    'filter': benchmark_filter(path, search_engine),
+                }
+                close_notebook(notebook)
+                print('Benchmarked {} notes with {} search'.format(
+                    size, search_engine), file=sys.stderr)
+        finally:
+            if keep is None:
+                shutil.rmtree(os.path.dirname(path))
+    return results
+
+
+def version():
+    """Return a description of the checked out version, if there is one."""
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=()):
+    """Yield (key path, median_ms) for every summary in results."""
+    for key, value in sorted(results.items()):
+        if 'median_ms' in value:
+            yield prefix + (key,), value['median_ms']
+        else:
+            for item in flatten(value, prefix + (key,)):
+                yield item
+
+
+def compare(baseline, results):
+    """Print the change in median times from `baseline` to `results`."""
+    old = dict(flatten(baseline['results']))
+    print('{:<70} {:>10} {:>10} {:>8}'.format(
+        'benchmark', 'old ms', 'new ms', 'ratio'))
+    for key, new_ms in flatten(results['results']):
+        if key in old:
+            ratio = new_ms / old[key] if old[key] else float('inf')
+            print('{:<70} {:>10.2f} {:>10.2f} {:>7.2f}x'.format(
+                '/'.join(key), old[key], new_ms, ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--sizes',
+        default='1000,10000',
+        help='comma-separated notebook sizes (default: %(default)s)')
+    parser.add_argument(
+        '--search-engines',
+        default=','.join(tv_index.SEARCH_ENGINES),
+        help='comma-separated search engines (default: %(default)s)')
+    parser.add_argument(
+        '--seed',
+        default=0,
+        type=int,
+        help='the random seed for generated notebooks (default: %(default)s)')
+    parser.add_argument(
+        '--keep',
+        help=('generate notebooks in this directory and keep them, reusing '
+              'any that are already there'))
+    parser.add_argument(
+        '-o',
+        '--output',
+        default='tv3-benchmark.json',
+        help='the file to write results to (default: %(default)s)')
+    parser.add_argument(
+        '--compare',
+        help='an earlier results file to compare the results with')
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    search_engines = [name.strip() for name in args.search_engines.split(',')]
+    results = {
+        'version': version(),
+        'date': datetime.datetime.now().isoformat(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'results': run(sizes, search_engines, args.seed, args.keep),
+    }
+    with open(args.output, 'w') as fp:
+        json.dump(results, fp, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,9 @@ setuptools.setup(
     author='Aramís Concepción Durán',
     description='A text-based note-taking application',
     entry_points='[console_scripts]\ntv3=terminal_velocity:main\n',
+    extras_require={
+        'fuzzy': ['numpy'],
+    },
     install_requires=[
         'urwid==2.1.2',
         'watchdog'
@@ -18,7 +21,8 @@ setuptools.setup(
     long_description=readme_text,
     name='tv3',
     package_dir={'': 'src'},
-    py_modules=['tv_notebook', 'terminal_velocity', 'urwid_ui'],
+    py_modules=['tv_notebook', 'tv_index', 'tv_fuzzy', 'tv_shard', 'tv_query',
+                'tv_stats', 'terminal_velocity', 'urwid_ui'],
     url='github.com/caelyx/tv3',
     version='0.1',
 )
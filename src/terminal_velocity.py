@@ -3,11 +3,95 @@
 
 import argparse
 import configparser
+import itertools
+import json
 import logging
 import logging.handlers
 import os
 import sys
-import urwid_ui
+import tv_index
+import tv_notebook
+import tv_query
+import tv_stats
+
+
+def print_matches(notes_dir, query, extension, extensions, exclude=None,
+                  cache_bytes=tv_notebook.DEFAULT_CACHE_BYTES,
+                  max_note_size=tv_notebook.DEFAULT_MAX_NOTE_SIZE,
+                  search_engine='brute', search_workers=None,
+                  index_cache=None, sort='mtime', match_mode='exact',
+                  limit=None, json_lines=False, out=None):
+    """Print the paths of the notes that match `query`, without the UI.
+
+    `notes_dir` is a notes directory or a list of them.
+
+    Matches are written to `out` (by default stdout) one per line as
+    they're found, or as JSON objects with their paths, titles,
+    modification times and (with several notes directories) the names of
+    their directories if `json_lines` is True. At most `limit` notes are
+    printed if it's given. Ordering by relevance has to wait for all of
+    the matches. The notes directory isn't watched for changes.
+
+    A single search isn't worth reading every note up front for, so an
+    empty query just lists the notes, and the index engine is only used
+    if its stored index is warm. Otherwise the notes are brute force
+    searched as they're streamed.
+
+    """
+    if out is None:
+        out = sys.stdout
+    if not query.split():
+        # Listing notes needs none of their contents, so there's nothing
+        # for an index or the search workers to read.
+        search_engine, match_mode = 'brute', 'exact'
+    search_function = tv_index.make_search_function(
+        search_engine, cache_dir=index_cache, match_mode=match_mode,
+        workers=search_workers)
+    notebook = tv_notebook.make_notebook(
+        notes_dir,
+        extension,
+        extensions,
+        search_function=search_function,
+        exclude=exclude,
+        cache_bytes=cache_bytes,
+        max_note_size=max_note_size,
+        load=False,
+    )
+    is_warm = getattr(search_function, 'is_warm', None)
+    if is_warm is not None and not is_warm(notebook.path):
+        notebook.search_function = tv_notebook.brute_force_search
+    try:
+        notebook.load(watch=False)
+        if sort == 'relevance':
+            score = getattr(notebook.search_function, 'relevance',
+                            tv_notebook.relevance)
+            matching_notes = tv_notebook.RankedResults(
+                notebook.search(query), query, k=limit or 50, score=score)
+        else:
+            matching_notes = notebook.iter_search(query)
+        for note in itertools.islice(matching_notes, limit):
+            if json_lines:
+                fields = {
+                    'path': note.abspath,
+                    'title': note.title,
+                    'mtime': note.mtime,
+                }
+                if note.notebook.name:
+                    fields['root'] = note.notebook.name
+                line = json.dumps(fields)
+            else:
+                line = note.abspath
+            out.write(line + '\n')
+            out.flush()
+    except BrokenPipeError:
+        # The reader went away, e.g. `tv3 --list | head`. Point stdout at
+        # /dev/null so that flushing it on exit doesn't fail too.
+        if out is sys.stdout:
+            os.dup2(os.open(os.devnull, os.O_WRONLY), out.fileno())
+    finally:
+        close = getattr(notebook.search_function, 'close', None)
+        if close is not None:
+            close()
 
 
 def main():
@@ -36,7 +120,30 @@ def main():
         '    extension = .txt\n'
         '    # The filename extensions to recognize in the notes dir.\n'
         '    extensions = .txt, .md, .markdown, .rst\n'
+        '    # One or more notes directories, separated by "' + os.pathsep +
+        '".\n'
         '    notes_dir = ~/Notes\n'
+        '    # Memory budget for cached note contents, in megabytes.\n'
+        '    cache_size = 64\n'
+        '    # Notes bigger than this many kilobytes are searched on disk\n'
+        '    # instead of being cached and indexed.\n'
+        '    max_note_size = 1024\n'
+        '    # How to search notes: brute (scan every note), index or\n'
+        '    # sharded.\n'
+        '    search_engine = brute\n'
+        '    # Worker processes for the sharded search engine, 0 for one\n'
+        '    # per CPU.\n'
+        '    search_workers = 0\n'
+        '    # Where to keep the persistent search index, empty for none.\n'
+        '    index_cache = ~/.cache/tv3\n'
+        '    # Milliseconds to wait after a keystroke before searching.\n'
+        '    search_delay = 30\n'
+        '    # How to order matching notes: mtime or relevance.\n'
+        '    sort = mtime\n'
+        '    # How to match search words: exact substrings or fuzzy.\n'
+        '    match_mode = exact\n'
+        '    # Whether lowercase search words match regardless of accents.\n'
+        '    ignore_accents = no\n'
         ''
         'if there is no config file (or an argument is missing from the)\n'
         'config file the default default will be used\n')
@@ -79,6 +186,120 @@ def main():
               'the notes dir for notes, a comma-separated list '
               '(default: %(default)s)'),
     )
+    parser.add_argument(
+        '--cache-size',
+        action='store',
+        default=defaults.get('cache_size', 64),
+        dest='cache_size',
+        help=('the memory budget for cached note contents, in megabytes '
+              '(default: %(default)s)'),
+        type=int,
+    )
+    parser.add_argument(
+        '--max-note-size',
+        action='store',
+        default=defaults.get('max_note_size', 1024),
+        dest='max_note_size',
+        help=('notes bigger than this many kilobytes are searched on disk '
+              'instead of being cached and indexed (default: %(default)s)'),
+        type=int,
+    )
+    parser.add_argument(
+        '--search-engine',
+        action='store',
+        choices=tv_index.SEARCH_ENGINES,
+        default=defaults.get('search_engine', 'brute'),
+        dest='search_engine',
+        help=('how to search notes, brute scans every note, index uses a '
+              'trigram index and sharded scans notes in parallel worker '
+              'processes (default: %(default)s)'),
+    )
+    parser.add_argument(
+        '--search-workers',
+        action='store',
+        default=defaults.get('search_workers', 0),
+        dest='search_workers',
+        help=('the number of worker processes for the sharded search '
+              'engine, 0 for one per CPU (default: %(default)s)'),
+        type=int,
+    )
+    parser.add_argument(
+        '--index-cache',
+        action='store',
+        default=defaults.get('index_cache', tv_index.default_cache_dir()),
+        dest='index_cache',
+        help=('the directory to keep the persistent search index in, an '
+              'empty string disables it (default: %(default)s)'),
+    )
+    parser.add_argument(
+        '--search-delay',
+        action='store',
+        default=defaults.get('search_delay', 30),
+        dest='search_delay',
+        help=('milliseconds to wait after a keystroke before searching '
+              '(default: %(default)s)'),
+        type=int,
+    )
+    parser.add_argument(
+        '--sort',
+        action='store',
+        choices=('mtime', 'relevance'),
+        default=defaults.get('sort', 'mtime'),
+        dest='sort',
+        help=('how to order matching notes, most recently modified first or '
+              'most relevant first (default: %(default)s)'),
+    )
+    parser.add_argument(
+        '--match-mode',
+        action='store',
+        choices=tv_index.MATCH_MODES,
+        default=defaults.get('match_mode', 'exact'),
+        dest='match_mode',
+        help=('how to match search words, as exact substrings or fuzzily '
+              'like fzf, best combined with --sort relevance '
+              '(default: %(default)s)'),
+    )
+    parser.add_argument(
+        '--ignore-accents',
+        action='store_true',
+        default=config.getboolean('DEFAULT', 'ignore_accents',
+                                  fallback=False),
+        dest='ignore_accents',
+        help=('match lowercase search words regardless of accents, so cafe '
+              'finds café (default: off)'),
+    )
+    parser.add_argument(
+        '-q',
+        '--query',
+        action='store',
+        default=None,
+        dest='query',
+        help=('print the paths of the notes matching QUERY and exit, '
+              'without starting the user interface'),
+    )
+    parser.add_argument(
+        '--list',
+        action='store_true',
+        default=False,
+        dest='list',
+        help='print the paths of all notes and exit',
+    )
+    parser.add_argument(
+        '--limit',
+        action='store',
+        default=None,
+        dest='limit',
+        help='print at most LIMIT notes with --query or --list',
+        type=int,
+    )
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        default=False,
+        dest='json_lines',
+        help=('print notes as JSON objects, one per line, with --query or '
+              '--list'),
+    )
     parser.add_argument(
         '-d',
         '--debug',
@@ -95,6 +316,24 @@ def main():
         dest='log_file',
         help='the file to log to (default: %(default)s)',
     )
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        default=defaults.get('stats', False),
+        dest='stats',
+        help='show a line of search and rendering timings (default: off)',
+    )
+    parser.add_argument(
+        '--profile',
+        action='store',
+        const='tv3.prof',
+        default=None,
+        dest='profile',
+        help=('profile with cProfile, write the profile to PROFILE (default: '
+              '%(const)s) and print timings on exit'),
+        metavar='PROFILE',
+        nargs='?',
+    )
     parser.add_argument(
         '-p',
         '--print-config',
@@ -106,9 +345,10 @@ def main():
     parser.add_argument(
         'notes_dir',
         action='store',
-        default=defaults.get('notes_dir', '~/Notes'),
-        help='the notes directory to use (default: %(default)s)',
-        nargs='?',
+        default=defaults.get('notes_dir', '~/Notes').split(os.pathsep),
+        help=('the notes directory to use, or several to search together '
+              '(default: %(default)s)'),
+        nargs='*',
     )
     args = parser.parse_args()
     extensions = []
@@ -137,13 +377,54 @@ def main():
     sh.setLevel(logging.CRITICAL)
     logger.addHandler(sh)
     logger.debug(args)
+    if args.profile:
+        tv_stats.stats.enable_profiling()
+    tv_query.set_ignore_accents(args.ignore_accents)
+    if args.query is not None or args.list:
+        tv_stats.stats.profile(
+            print_matches,
+            notes_dir=args.notes_dir,
+            query=args.query or '',
+            extension=args.extension,
+            extensions=args.extensions,
+            exclude=args.exclude,
+            cache_bytes=args.cache_size * 1024 * 1024,
+            max_note_size=args.max_note_size * 1024,
+            search_engine=args.search_engine,
+            search_workers=args.search_workers or None,
+            index_cache=args.index_cache,
+            sort=args.sort,
+            match_mode=args.match_mode,
+            limit=args.limit,
+            json_lines=args.json_lines)
+        logger.debug('Timings:\n' + tv_stats.stats.summary())
+        if args.profile:
+            print(tv_stats.stats.summary(), file=sys.stderr)
+            print(tv_stats.stats.dump_profile(args.profile), file=sys.stderr)
+        return
+    # Only the user interface needs urwid.
+    import urwid_ui
     #try:
-    urwid_ui.launch(
+    tv_stats.stats.profile(
+        urwid_ui.launch,
         notes_dir=args.notes_dir,
         editor=args.editor,
         extension=args.extension,
         extensions=args.extensions,
-        exclude=args.exclude)
+        exclude=args.exclude,
+        cache_bytes=args.cache_size * 1024 * 1024,
+        max_note_size=args.max_note_size * 1024,
+        search_engine=args.search_engine,
+        search_workers=args.search_workers or None,
+        index_cache=args.index_cache,
+        search_delay=args.search_delay / 1000.0,
+        show_stats=args.stats,
+        sort=args.sort,
+        match_mode=args.match_mode)
+    logger.debug('Timings:\n' + tv_stats.stats.summary())
+    if args.profile:
+        print(tv_stats.stats.summary())
+        print(tv_stats.stats.dump_profile(args.profile))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,272 @@
+"""Fuzzy, fzf-style matching of notes."""
+
+import logging
+logger = logging.getLogger("tv3")
+
+import threading
+import time
+
+import tv_notebook
+import tv_query
+
+
+# The scores for a matched character, a character at the start of a word,
+# a character right after the previous match, and each skipped character.
+SCORE_MATCH = 16
+BONUS_BOUNDARY = 8
+BONUS_CONSECUTIVE = 4
+PENALTY_GAP = 1
+
+# The score of a word found in a note's contents rather than its title.
+SCORE_CONTENTS = 8
+
+WORD_SEPARATORS = ' \t-_./\\'
+
+# The mask of a text with every character, see char_mask().
+ALL_CHARACTERS = (1 << 64) - 1
+
+def optional_numpy():
+    """Return the numpy module, or None if it isn't installed.
+
+    NumPy is slow to import, so it's only imported for fuzzy searches.
+
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def char_mask(text):
+    """Return a 64-bit mask with a bit set for each character in `text`.
+
+    Characters are folded onto the 64 bits by code point, so the mask of a
+    word being a subset of a text's mask is necessary but not sufficient
+    for the text to contain all of the word's characters.
+
+    """
+    mask = 0
+    for character in set(text):
+        mask |= 1 << (ord(character) & 63)
+    return mask
+
+
+def is_subsequence(word, text):
+    """Return True if the characters of `word` appear in order in `text`."""
+    characters = iter(text)
+    return all(character in characters for character in word)
+
+
+def fuzzy_score(word, text):
+    """Return the fzf-style score of `word` against `text`, or None.
+
+    Like fzf's first algorithm this finds the first occurrence of the word
+    as a subsequence, then scans backwards from its end to find the
+    shortest match ending there, and scores that match.
+
+    """
+    position = 0
+    for character in word:
+        position = text.find(character, position)
+        if position < 0:
+            return None
+        position += 1
+    end = position
+    start = end
+    for character in reversed(word):
+        start = text.rfind(character, 0, start)
+    score = 0
+    previous = None
+    position = start
+    for character in word:
+        position = text.find(character, position)
+        score += SCORE_MATCH
+        if position == 0 or text[position - 1] in WORD_SEPARATORS:
+            score += BONUS_BOUNDARY
+        if previous is not None:
+            if position == previous + 1:
+                score += BONUS_CONSECUTIVE
+            else:
+                score -= PENALTY_GAP * min(position - previous - 1, 10)
+        previous = position
+        position += 1
+    return score
+
+
+def fuzzy_is_refinement(old_query, new_query):
+    """Return True if every fuzzy match for new_query matches old_query."""
+    new_words = new_query.strip().split()
+    for old_word in old_query.strip().split():
+        if not any(is_subsequence(old_word, new_word)
+                   for new_word in new_words):
+            return False
+    return True
+
+
+class FuzzySearch(object):
+    """A PlainTextNoteBook search function that matches words fuzzily.
+
+    Every word of the query must appear as a subsequence of a note's title,
+    or of a line of its contents. Words are matched case-insensitively if
+    they're all lowercase, as in brute_force_search.
+
+    When attached to a notebook, a 64-bit character mask of each note's
+    title and contents is kept in a packed array, and a query first checks
+    its words' masks against all of them at once (with NumPy if it's
+    installed). Only the notes that pass are matched line by line, see
+    tv_notebook.line_subsequence(). The
+    relevance() method scores matches for ordering by relevance.
+
+    """
+
+    is_refinement = staticmethod(fuzzy_is_refinement)
+
+    def __init__(self):
+        self._notebook = None
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._notes = []
+        self._masks = []
+        self._free = []
+        self._array = None
+        self._numpy = optional_numpy()
+
+    def attach(self, notebook):
+        """Mask all of the notes in `notebook` and keep the masks current."""
+        for note in notebook:
+            self.note_added(note)
+        self._notebook = notebook
+        notebook.add_listener(self)
+        logger.debug('Masked {} notes for fuzzy search'.format(
+            len(self._slots)))
+
+    def note_added(self, note):
+        try:
+            if note.is_large:
+                # Large notes aren't read, so they're always candidates.
+                mask = ALL_CHARACTERS
+            else:
+                mask = char_mask(note.contents_key)
+        except (IOError, OSError) as e:
+            logger.error('Could not read {}: {}'.format(note.abspath, e))
+            mask = 0
+        mask |= char_mask(note.title_key)
+        with self._lock:
+            slot = self._slots.get(note.abspath)
+            if slot is None:
+                if self._free:
+                    slot = self._free.pop()
+                else:
+                    slot = len(self._notes)
+                    self._notes.append(None)
+                    self._masks.append(0)
+                self._slots[note.abspath] = slot
+            self._notes[slot] = note
+            self._masks[slot] = mask
+            self._array = None
+
+    def note_changed(self, note):
+        self.note_added(note)
+
+    def note_removed(self, note):
+        with self._lock:
+            slot = self._slots.pop(note.abspath, None)
+            if slot is not None:
+                self._notes[slot] = None
+                self._masks[slot] = 0
+                self._free.append(slot)
+                self._array = None
+
+    def candidates(self, search_words):
+        """Return the notes whose masks have all of the words' characters.
+
+        The notes are in the notebook's order, most recently modified first.
+
+        """
+        mask = char_mask(tv_query.search_key(''.join(search_words)))
+        numpy = self._numpy
+        with self._lock:
+            if numpy is not None:
+                if self._array is None:
+                    self._array = numpy.array(self._masks, dtype=numpy.uint64)
+                query_mask = numpy.uint64(mask)
+                slots = numpy.flatnonzero(
+                    (self._array & query_mask) == query_mask).tolist()
+            else:
+                slots = [slot for slot, note_mask in enumerate(self._masks)
+                         if note_mask & mask == mask]
+            candidates = [self._notes[slot] for slot in slots
+                          if self._notes[slot] is not None]
+        return self._notebook.by_recency(candidates)
+
+    @staticmethod
+    def _matches(note, keys):
+        large = note.is_large
+        for lower, key in keys:
+            title = note.title_key if lower else note.title_nfc
+            if is_subsequence(key, title):
+                continue
+            if large:
+                if not tv_notebook.scan_file(note.abspath, key, lines=True):
+                    return False
+            else:
+                contents = note.contents_key if lower else note.contents
+                if tv_notebook.line_subsequence(contents, key) is None:
+                    return False
+        return True
+
+    def iterate(self, notebook, query):
+        """Yield the matches for `query` in `notebook` as they're found."""
+        search_words = query.strip().split()
+        if not search_words:
+            return iter(notebook)
+        if notebook is self._notebook:
+            notes = self.candidates(search_words)
+        else:
+            notes = notebook
+        keys = [(search_word.islower(), tv_query.word_key(search_word))
+                for search_word in search_words]
+        return (note for note in notes if self._matches(note, keys))
+
+    def __call__(self, notebook, query):
+        return list(self.iterate(notebook, query))
+
+    @staticmethod
+    def match_offsets(note, search_words):
+        """Return the offsets of the characters matched in note.contents.
+
+        Each word's characters are matched in the first line they all
+        appear in, in order, as (start, start + 1) offsets.
+
+        """
+        offsets = []
+        text, text_key = note.contents, note.contents_key
+        to_text = tv_query.key_offsets(text, text_key)
+        for search_word in search_words:
+            key = tv_query.word_key(search_word)
+            folded = search_word.islower()
+            contents = text_key if folded else text
+            positions = tv_notebook.line_subsequence(contents, key)
+            if positions is None:
+                continue
+            for position in positions:
+                if folded and to_text is not None:
+                    position = to_text(position)
+                offsets.append((position, position + 1))
+        offsets.sort()
+        return offsets
+
+    @staticmethod
+    def relevance(note, search_words, now=None):
+        """Return how well `note` fuzzily matches `search_words`."""
+        if now is None:
+            now = time.time()
+        score = 0.0
+        for search_word in search_words:
+            title = (note.title_key if search_word.islower()
+                     else note.title_nfc)
+            word_score = fuzzy_score(tv_query.word_key(search_word), title)
+            score += SCORE_CONTENTS if word_score is None else word_score
+        age_in_days = max(0.0, now - note.mtime) / 86400
+        return score + 3.0 / (1 + age_in_days / 7)
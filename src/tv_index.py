@@ -0,0 +1,578 @@
+"""Index-backed search functions for notebooks."""
+
+import logging
+logger = logging.getLogger("tv3")
+
+import array
+import hashlib
+import os
+import sqlite3
+import threading
+
+import tv_fuzzy
+import tv_notebook
+import tv_query
+import tv_shard
+
+
+def trigrams(text):
+    """Return the set of all three-character substrings of `text`."""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TrigramIndex(object):
+    """An inverted index from trigrams to the keys of documents containing them.
+
+    Documents are indexed by their tv_query.search_key(), so the candidates
+    for a search word are a superset of the documents that contain the
+    word whatever its case. Words shorter than three characters can't be looked
+    up in the index.
+
+    Each document gets an integer id, and each trigram's posting list is an
+    array of ids in ascending order, which is about a tenth of the memory of
+    a set of keys. Ids are never reused: removing a document only marks its
+    id dead, and dead ids are dropped from the posting lists once there are
+    as many of them as live ones.
+
+    An index can start from the posting lists in an IndexStore: `keys` are
+    the keys of the stored documents by id, None for the ids of documents
+    that are no longer live, and each trigram's posting list is read from
+    `store` when it's first needed.
+
+    """
+
+    # Dead ids are only compacted away once there are at least this many.
+    MIN_COMPACT = 1024
+
+    def __init__(self, keys=(), store=None):
+        self._postings = {}
+        # Each key's id, and each id's key or None if it's dead.
+        self._keys = list(keys)
+        self._ids = {key: doc_id for doc_id, key in enumerate(self._keys)
+                     if key is not None}
+        self._dead = len(self._keys) - len(self._ids)
+        self._store = store
+
+    def _posting(self, gram):
+        """Return the posting list of `gram`, or None if it has none."""
+        posting = self._postings.get(gram)
+        if posting is None and self._store is not None:
+            posting = self._postings[gram] = array.array('I')
+            data = self._store.posting(gram)
+            if data is not None:
+                posting.frombytes(data)
+        return posting
+
+    def add(self, key, text):
+        """Index `text` under `key`, replacing any previous text for key."""
+        self.add_trigrams(key, trigrams(tv_query.search_key(text)))
+
+    def add_trigrams(self, key, grams):
+        """Index the already computed trigrams `grams` under `key`."""
+        self.remove(key)
+        doc_id = len(self._keys)
+        self._keys.append(key)
+        self._ids[key] = doc_id
+        for gram in grams:
+            posting = self._posting(gram)
+            if posting is None:
+                posting = self._postings[gram] = array.array('I')
+            posting.append(doc_id)
+
+    def remove(self, key):
+        """Remove `key` from the index, if it's there."""
+        doc_id = self._ids.pop(key, None)
+        if doc_id is None:
+            return
+        self._keys[doc_id] = None
+        self._dead += 1
+        if self._dead >= max(self.MIN_COMPACT, len(self._ids)):
+            self._compact()
+
+    def _compact(self):
+        """Drop the dead ids from the posting lists."""
+        keys = self._keys
+        for gram, posting in list(self._postings.items()):
+            live = array.array('I', [doc_id for doc_id in posting
+                                     if keys[doc_id] is not None])
+            # Empty lists are kept while there's a store, so that they're
+            # not read from it again.
+            if live or self._store is not None:
+                self._postings[gram] = live
+            else:
+                del self._postings[gram]
+        self._dead = 0
+
+    def load_all(self):
+        """Read every posting list that hasn't been read from the store yet.
+
+        The index no longer needs the store afterwards.
+
+        """
+        if self._store is None:
+            return
+        for gram, data in self._store.postings():
+            if gram not in self._postings:
+                posting = self._postings[gram] = array.array('I')
+                posting.frombytes(data)
+        self._store = None
+
+    def snapshot(self, keep):
+        """Return the documents for which keep(key) is True, for storing.
+
+        Returns (keys, postings): the documents' keys by their new ids,
+        which are numbered from 0, and a list of (trigram, posting list)
+        pairs with the posting lists as bytes. Every posting list is read
+        from the store first.
+
+        """
+        self.load_all()
+        new_ids = {}
+        keys = []
+        for doc_id, key in enumerate(self._keys):
+            if key is not None and keep(key):
+                new_ids[doc_id] = len(keys)
+                keys.append(key)
+        postings = []
+        for gram, posting in self._postings.items():
+            renumbered = array.array('I', [new_ids[doc_id] for doc_id in posting
+                                           if doc_id in new_ids])
+            if renumbered:
+                postings.append((gram, renumbered.tobytes()))
+        return keys, postings
+
+    def candidates(self, word):
+        """Return the set of keys that may contain `word`.
+
+        Returns None if `word` is too short to be looked up in the index.
+
+        """
+        grams = trigrams(tv_query.search_key(word))
+        if not grams:
+            return None
+        empty = array.array('I')
+        postings = sorted(
+            (self._posting(gram) or empty for gram in grams), key=len)
+        result = set(postings[0])
+        for posting in postings[1:]:
+            if not result:
+                break
+            result.intersection_update(posting)
+        keys = self._keys
+        return {keys[doc_id] for doc_id in result
+                if keys[doc_id] is not None}
+
+    def __contains__(self, key):
+        return key in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+
+def default_cache_dir():
+    """Return the directory for persistent indexes under the XDG cache dir."""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or '~/.cache'
+    return os.path.join(os.path.expanduser(cache_home), 'tv3')
+
+
+class IndexStore(object):
+    """A SQLite database of a TrigramIndex and its notes' stat signatures.
+
+    The store lets an IndexedSearch start without reading the notes whose
+    stat signatures haven't changed since the index was stored, and
+    without reading the whole index either: only the notes' ids, paths and
+    signatures are loaded at startup, and each trigram's posting list, an
+    array of note ids, when a search first needs it. The index is written
+    as a whole by replace().
+
+    A read transaction is held from load() until replace(), so posting
+    lists read in the meantime match the notes that were loaded even if
+    another process replaces the index. The database is in WAL mode, so
+    that doesn't block the other process.
+
+    Each notebook gets its own database in `cache_dir`, named after a hash
+    of the notebook's path and of whether search keys ignore accents.
+    Paths and trigrams are stored as UTF-8 BLOBs with any lone surrogates
+    kept, so that notes with undecodable filenames (decoded with
+    surrogateescape) can be stored too.
+
+    """
+
+    # Bump this when the schema or the indexed text changes.
+    VERSION = 4
+
+    def __init__(self, cache_dir, notebook_path):
+        digest = hashlib.sha1(notebook_path.encode('utf-8', 'surrogateescape'))
+        if tv_query.ignore_accents:
+            digest.update(b'\0ignore-accents')
+        self.path = os.path.join(
+            os.path.abspath(os.path.expanduser(cache_dir)),
+            digest.hexdigest() + '.sqlite3')
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is not None:
+            return self._connection
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Transactions are begun and committed explicitly.
+        connection = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None)
+        connection.execute('PRAGMA journal_mode = WAL')
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.VERSION:
+            logger.debug('Rebuilding index store {}'.format(self.path))
+            connection.execute('DROP TABLE IF EXISTS notes')
+            connection.execute('DROP TABLE IF EXISTS postings')
+            connection.execute('PRAGMA user_version = {:d}'.format(
+                self.VERSION))
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS notes ('
+            'id INTEGER PRIMARY KEY, abspath BLOB, mtime_ns INTEGER, '
+            'size INTEGER, inode INTEGER)')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS postings ('
+            'gram BLOB PRIMARY KEY, ids BLOB) WITHOUT ROWID')
+        self._connection = connection
+        return connection
+
+    def is_empty(self):
+        """Return True if no notes are stored, without creating the store."""
+        if not os.path.exists(self.path):
+            return True
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    'SELECT 1 FROM notes LIMIT 1').fetchone()
+        except (sqlite3.Error, OSError):
+            return True
+        return row is None
+
+    def load(self):
+        """Return the stored notes and begin reading the stored index.
+
+        Returns a dict of abspath: (id, signature), and one more than the
+        largest id.
+
+        """
+        entries = {}
+        count = 0
+        with self._lock:
+            connection = self._connect()
+            if not connection.in_transaction:
+                connection.execute('BEGIN')
+            rows = connection.execute(
+                'SELECT id, abspath, mtime_ns, size, inode FROM notes')
+            for doc_id, abspath, mtime_ns, size, inode in rows:
+                entries[self._decode(abspath)] = (
+                    doc_id, (mtime_ns, size, inode))
+                count = max(count, doc_id + 1)
+        return entries, count
+
+    def posting(self, gram):
+        """Return the stored posting list of `gram` as bytes, or None."""
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    'SELECT ids FROM postings WHERE gram = ?',
+                    (self._encode(gram),)).fetchone()
+        except sqlite3.Error as e:
+            logger.error('Could not read index store {}: {}'.format(
+                self.path, e))
+            return None
+        return None if row is None else bytes(row[0])
+
+    def postings(self):
+        """Return a list of every stored (trigram, posting list) pair."""
+        with self._lock:
+            rows = self._connect().execute('SELECT gram, ids FROM postings')
+            return [(self._decode(gram), bytes(ids)) for gram, ids in rows]
+
+    @staticmethod
+    def _encode(text):
+        return text.encode('utf-8', 'surrogatepass')
+
+    @staticmethod
+    def _decode(data):
+        return bytes(data).decode('utf-8', 'surrogatepass')
+
+    def replace(self, notes, postings):
+        """Replace the stored index, ending the read transaction.
+
+        `notes` is a list of (id, abspath, signature) and `postings` one of
+        (trigram, posting list) pairs as returned by
+        TrigramIndex.snapshot().
+
+        """
+        try:
+            with self._lock:
+                connection = self._connect()
+                if connection.in_transaction:
+                    connection.execute('COMMIT')
+                connection.execute('BEGIN IMMEDIATE')
+                try:
+                    connection.execute('DELETE FROM notes')
+                    connection.execute('DELETE FROM postings')
+                    connection.executemany(
+                        'INSERT INTO notes VALUES (?, ?, ?, ?, ?)',
+                        ((doc_id, self._encode(abspath)) + tuple(signature)
+                         for doc_id, abspath, signature in notes))
+                    connection.executemany(
+                        'INSERT INTO postings VALUES (?, ?)',
+                        ((self._encode(gram), ids) for gram, ids in postings))
+                except BaseException:
+                    connection.execute('ROLLBACK')
+                    raise
+                connection.execute('COMMIT')
+        except (sqlite3.Error, OSError) as e:
+            logger.error('Could not update index store {}: {}'.format(
+                self.path, e))
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class IndexedSearch(object):
+    """A PlainTextNoteBook search function backed by a TrigramIndex.
+
+    Has the same semantics as brute_force_search. The index narrows the
+    notes down to candidates by intersecting the posting lists of the
+    query's words and phrases (taking the union for alternatives joined
+    by OR), and only the candidates are checked with brute_force_search.
+
+    Once attached to a notebook the index is updated incrementally as notes
+    are added, removed or changed. Called with any other iterable of notes
+    it falls back to brute_force_search.
+
+    If `cache_dir` is given the index is also kept in an IndexStore there.
+    When attaching, only the notes whose stat signatures have changed since
+    it was stored are read, and the rest of the index is read from the
+    store as it's needed. The index is stored after it's first built, and
+    again when the search function is closed if it has changed.
+
+    Notes bigger than the notebook's max_note_size are indexed by title
+    only and are always candidates, so their contents are scanned on disk.
+
+    """
+
+    def __init__(self, cache_dir=None):
+        self._index = TrigramIndex()
+        self._notes = {}
+        # The stat signature each note was indexed at, or None if it
+        # shouldn't be stored.
+        self._signatures = {}
+        self._large = set()
+        self._notebook = None
+        self._lock = threading.Lock()
+        self.cache_dir = cache_dir
+        self._store = None
+        # Whether the index has changed since it was loaded or stored.
+        self._dirty = False
+
+    def attach(self, notebook):
+        """Index all of the notes in `notebook` and keep the index current."""
+        stored = {}
+        if self.cache_dir:
+            self._store = IndexStore(self.cache_dir, notebook.path)
+            try:
+                stored, count = self._store.load()
+            except (sqlite3.Error, OSError) as e:
+                logger.error('Could not load index store {}: {}'.format(
+                    self._store.path, e))
+                self._store = None
+        if stored:
+            keys = [None] * count
+            for abspath, (doc_id, _) in stored.items():
+                keys[doc_id] = abspath
+            self._index = TrigramIndex(keys, store=self._store)
+        warm = bool(stored)
+        read = 0
+        for note in notebook:
+            entry = stored.pop(note.abspath, None)
+            signature = note.signature
+            if signature is None:
+                try:
+                    signature = tv_notebook.ContentCache.signature(
+                        os.stat(note.abspath))
+                except OSError:
+                    pass
+            if (entry is not None and entry[1] == signature
+                    and not note.is_large):
+                with self._lock:
+                    self._notes[note.abspath] = note
+                    self._signatures[note.abspath] = signature
+            else:
+                self._index_note(note, signature)
+                read += 1
+        with self._lock:
+            for abspath in stored:
+                self._index.remove(abspath)
+                self._dirty = True
+        # Searches only use the index once it has every note.
+        self._notebook = notebook
+        notebook.add_listener(self)
+        logger.debug('Indexed {} notes, read {}'.format(
+            len(self._index), read))
+        if not warm:
+            # A new index is stored straight away, a loaded one that has
+            # changed is stored on close() so as not to read all of it now.
+            self.save()
+
+    def is_warm(self, notebook_path):
+        """Return True if there's a stored index for the notebook's path.
+
+        Attaching to a notebook without one reads every note.
+
+        """
+        if not self.cache_dir:
+            return False
+        store = IndexStore(self.cache_dir, notebook_path)
+        try:
+            return not store.is_empty()
+        finally:
+            store.close()
+
+    def _index_note(self, note, signature=None):
+        """Read and index `note`.
+
+        `signature` must be taken before the note's contents are read. The
+        note isn't stored if it can't be read or if it's large.
+
+        """
+        if signature is None:
+            try:
+                signature = tv_notebook.ContentCache.signature(
+                    os.stat(note.abspath))
+            except OSError:
+                pass
+        large = False
+        try:
+            large = note.is_large
+            contents = '' if large else note.contents_key
+        except (IOError, OSError) as e:
+            logger.error('Could not index {}: {}'.format(note.abspath, e))
+            contents = ''
+            signature = None
+        if large:
+            signature = None
+        grams = trigrams(note.title_key) | trigrams(contents)
+        with self._lock:
+            self._index.add_trigrams(note.abspath, grams)
+            self._notes[note.abspath] = note
+            self._signatures[note.abspath] = signature
+            if large:
+                self._large.add(note.abspath)
+            else:
+                self._large.discard(note.abspath)
+            self._dirty = True
+
+    def note_added(self, note):
+        self._index_note(note)
+
+    def note_changed(self, note):
+        self._index_note(note)
+
+    def note_removed(self, note):
+        with self._lock:
+            self._index.remove(note.abspath)
+            self._notes.pop(note.abspath, None)
+            self._signatures.pop(note.abspath, None)
+            self._large.discard(note.abspath)
+            self._dirty = True
+
+    def save(self):
+        """Write the index to the store if it has changed."""
+        with self._lock:
+            if self._store is None or not self._dirty:
+                return
+            signatures = self._signatures
+            keys, postings = self._index.snapshot(
+                lambda key: signatures.get(key) is not None)
+            notes = [(doc_id, key, signatures[key])
+                     for doc_id, key in enumerate(keys)]
+            self._dirty = False
+        self._store.replace(notes, postings)
+
+    def close(self):
+        """Store the index if it has changed."""
+        self.save()
+
+    def candidates(self, clauses):
+        """Return the notes that may contain a word of each of `clauses`.
+
+        Each clause is a list of alternative words or phrases, see
+        tv_query.Query.literal_clauses(). The notes are in the notebook's
+        order, most recently modified first. Returns None if none of the
+        clauses can be looked up in the index.
+
+        """
+        keys = None
+        with self._lock:
+            for clause in clauses:
+                clause_keys = set()
+                for search_word in clause:
+                    word_keys = self._index.candidates(search_word)
+                    if word_keys is None:
+                        clause_keys = None
+                        break
+                    clause_keys |= word_keys
+                if clause_keys is None:
+                    continue
+                if keys is None:
+                    keys = clause_keys
+                else:
+                    keys &= clause_keys
+                if not keys:
+                    break
+            if keys is None:
+                return None
+            keys |= self._large
+            candidates = [self._notes[key] for key in keys]
+        return self._notebook.by_recency(candidates)
+
+    def iterate(self, notebook, query):
+        """Yield the matches for `query` in `notebook` as they're found."""
+        candidates = None
+        if notebook is self._notebook:
+            candidates = self.candidates(
+                tv_query.compile_query(query).literal_clauses())
+        if candidates is None:
+            candidates = notebook
+        return tv_notebook.iter_brute_force_search(candidates, query)
+
+    def __call__(self, notebook, query):
+        return list(self.iterate(notebook, query))
+
+
+# The search engines and match modes that can be chosen by name.
+SEARCH_ENGINES = ('brute', 'index', 'sharded')
+MATCH_MODES = ('exact', 'fuzzy')
+
+
+def make_search_function(search_engine, cache_dir=None, match_mode='exact',
+                         workers=None):
+    """Return a new search function for the named search engine.
+
+    `cache_dir` is where the index engine keeps its persistent index, if
+    it's empty the index is rebuilt from the notes on every run. `workers`
+    is the number of processes for the sharded engine, by default one per
+    CPU. The fuzzy match mode has its own engine, so `search_engine` is
+    then ignored.
+
+    """
+    if match_mode == 'fuzzy':
+        return tv_fuzzy.FuzzySearch()
+    elif match_mode != 'exact':
+        raise ValueError('Unknown match mode: {}'.format(match_mode))
+    if search_engine == 'brute':
+        return tv_notebook.brute_force_search
+    elif search_engine == 'index':
+        return IndexedSearch(cache_dir=cache_dir)
+    elif search_engine == 'sharded':
+        return tv_shard.ShardedSearch(workers=workers)
+    raise ValueError('Unknown search engine: {}'.format(search_engine))
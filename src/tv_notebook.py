@@ -2,10 +2,35 @@
 
 import logging
 logger = logging.getLogger("tv3")
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+import tv_query
+import tv_stats
 
+import bisect
+import collections
+import collections.abc
+import concurrent.futures
+import heapq
+import math
+import mmap
 import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+
+# The default memory budget for cached note contents, in bytes.
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+# Notes larger than this many bytes are searched on disk instead of being
+# decoded, cached and indexed.
+DEFAULT_MAX_NOTE_SIZE = 1024 * 1024
+
+# How many bytes of a large note scan_file() case-folds at a time.
+SCAN_CHUNK_BYTES = 256 * 1024
+
+# How many queries' results a notebook remembers.
+DEFAULT_RESULT_CACHE_SIZE = 32
 
 
 class Error(Exception):
@@ -53,25 +78,445 @@ class DelNoteError(Error):
         return repr(self.value)
 
 
+def decode_note(data):
+    """Return the NFC-normalized text of a note's UTF-8 bytes `data`."""
+    return unicodedata.normalize(
+        'NFC', data.decode('utf-8', errors='ignore'))
+
+
+class ContentCache(object):
+    """An LRU cache of decoded note contents, validated by file stats.
+
+    Entries are keyed on abspath and stamped with the file's
+    (st_mtime_ns, st_size, st_ino) signature, so a cached entry is reused
+    only while the file on disk is unchanged. Each entry holds both the
+    decoded text, normalized to NFC, and its tv_query.search_key() for
+    case-insensitive matching. The least recently used entries
+    are evicted once the cached strings exceed `max_bytes`. The cache can
+    be used from several threads.
+
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def signature(stat_result):
+        """Return the cache validation key for an os.stat() result."""
+        return (stat_result.st_mtime_ns, stat_result.st_size,
+                stat_result.st_ino)
+
+    def get(self, abspath, signature=None):
+        """Return (contents, contents' search key) of the file at abspath.
+
+        A cached entry is only used if it was read at `signature`, the
+        file's signature as last seen by the caller. The file is stat'ed
+        for its signature if none is given.
+
+        """
+        if signature is None:
+            signature = self.signature(os.stat(abspath))
+        with self._lock:
+            entry = self._entries.get(abspath)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(abspath)
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+        with open(abspath, 'rb') as fp:
+            signature = self.signature(os.fstat(fp.fileno()))
+            contents = decode_note(fp.read())
+        contents_key = tv_query.search_key(contents)
+        self._store(abspath, signature, contents, contents_key)
+        return contents, contents_key
+
+    def discard(self, abspath):
+        """Drop the cached entry for abspath, if there is one."""
+        with self._lock:
+            self._discard(abspath)
+
+    def _discard(self, abspath):
+        entry = self._entries.pop(abspath, None)
+        if entry is not None:
+            self._size -= entry[3]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _store(self, abspath, signature, contents, contents_key):
+        size = sys.getsizeof(contents)
+        if contents_key is not contents:
+            size += sys.getsizeof(contents_key)
+        with self._lock:
+            self._discard(abspath)
+            if size > self.max_bytes:
+                return
+            self._entries[abspath] = (
+                signature, contents, contents_key, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted[3]
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        """The approximate number of bytes held by cached strings."""
+        return self._size
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        hit_rate = (100.0 * self.hits / lookups) if lookups else 0.0
+        return ('{} entries, {} bytes, {} hits, {} misses ({:.1f}% hit '
+                'rate), {} evictions').format(
+                    len(self), self.size, self.hits, self.misses, hit_rate,
+                    self.evictions)
+
+
+class ResultCache(object):
+    """An LRU cache of search results, validated by notebook generation.
+
+    Entries are keyed on the query and stamped with the notebook's
+    generation when the search started, so results are only reused while
+    no note has been added, removed or changed since. At most `max_entries`
+    queries are kept. The cache can be used from several threads.
+
+    """
+
+    def __init__(self, max_entries=DEFAULT_RESULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query, generation):
+        """Return the cached results for `query`, or None."""
+        with self._lock:
+            entry = self._entries.get(query)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(query)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[query]
+            self.misses += 1
+            return None
+
+    def put(self, query, generation, results):
+        with self._lock:
+            self._entries[query] = (generation, results)
+            self._entries.move_to_end(query)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        hit_rate = (100.0 * self.hits / lookups) if lookups else 0.0
+        return '{} queries, {} hits, {} misses ({:.1f}% hit rate)'.format(
+            len(self), self.hits, self.misses, hit_rate)
+
+
+class TitleIndex(object):
+    """Finds the most recent note whose title starts with a prefix.
+
+    Holds the search keys of the notes' titles in a sorted list, so the
+    titles with a given prefix are a slice of it found by bisection. Over
+    the list is a segment tree of the notes' recency keys, which gives the
+    most recent note in any slice in logarithmic time. Adding or removing
+    a note shifts the list, so the tree is rebuilt the next time it's
+    needed, while a note changing only updates its own branch.
+
+    """
+
+    def __init__(self):
+        # Sorted (title key, abspath) pairs, and each note's recency key.
+        self._titles = []
+        self._keys = {}
+        # The segment tree: leaves from len(self._titles) on, each parent
+        # holding the smaller of its children, None until it's rebuilt.
+        self._tree = None
+
+    @staticmethod
+    def _entry(note):
+        return (note.title_key, note.abspath)
+
+    def add(self, note, recency_key, ordered=True):
+        """Add a note. If not `ordered` the caller must call sort()."""
+        if ordered:
+            bisect.insort(self._titles, self._entry(note))
+        else:
+            self._titles.append(self._entry(note))
+        self._keys[note.abspath] = recency_key
+        self._tree = None
+
+    def sort(self):
+        self._titles.sort()
+
+    def remove(self, note):
+        entry = self._entry(note)
+        del self._titles[bisect.bisect_left(self._titles, entry)]
+        del self._keys[note.abspath]
+        self._tree = None
+
+    def update(self, note, recency_key):
+        """Give a note a new recency key."""
+        self._keys[note.abspath] = recency_key
+        tree = self._tree
+        if tree is None:
+            return
+        position = bisect.bisect_left(self._titles, self._entry(note))
+        position += len(self._titles)
+        tree[position] = recency_key
+        while position > 1:
+            position //= 2
+            tree[position] = min(tree[2 * position], tree[2 * position + 1])
+
+    def _build(self):
+        count = len(self._titles)
+        keys = self._keys
+        tree = [None] * count + [keys[abspath] for _, abspath in self._titles]
+        for position in range(count - 1, 0, -1):
+            tree[position] = min(tree[2 * position], tree[2 * position + 1])
+        self._tree = tree
+        return tree
+
+    def _slice(self, prefix):
+        """Return the positions of the titles starting with `prefix`."""
+        prefix = tv_query.search_key(prefix)
+        titles = self._titles
+        low = bisect.bisect_left(titles, (prefix,))
+        high = bisect.bisect_left(titles, (prefix + '\U0010ffff',), low)
+        return low, high
+
+    def first(self, prefix):
+        """Return the recency key of the newest title starting with `prefix`.
+
+        Titles are compared by search key. Returns None if no title starts
+        with `prefix`.
+
+        """
+        low, high = self._slice(prefix)
+        if low == high:
+            return None
+        titles = self._titles
+        tree = self._tree
+        if tree is None:
+            tree = self._build()
+        best = None
+        low += len(titles)
+        high += len(titles)
+        while low < high:
+            if low & 1:
+                if best is None or tree[low] < best:
+                    best = tree[low]
+                low += 1
+            if high & 1:
+                high -= 1
+                if best is None or tree[high] < best:
+                    best = tree[high]
+            low //= 2
+            high //= 2
+        return best
+
+    def newest(self, prefix):
+        """Yield the recency keys of the titles starting with `prefix`.
+
+        The keys come most recent first, each found in logarithmic time by
+        walking down the tree from the nodes covering the prefix's slice.
+        The index mustn't change while they're being yielded.
+
+        """
+        low, high = self._slice(prefix)
+        if low == high:
+            return
+        count = len(self._titles)
+        tree = self._tree
+        if tree is None:
+            tree = self._build()
+        heap = []
+        low += count
+        high += count
+        while low < high:
+            if low & 1:
+                heap.append((tree[low], low))
+                low += 1
+            if high & 1:
+                high -= 1
+                heap.append((tree[high], high))
+            low //= 2
+            high //= 2
+        heapq.heapify(heap)
+        while heap:
+            key, position = heapq.heappop(heap)
+            if position >= count:
+                yield key
+                continue
+            for child in (2 * position, 2 * position + 1):
+                heapq.heappush(heap, (tree[child], child))
+
+
+def line_subsequence(text, word, newline='\n', start=0, end=None):
+    """Return the offsets of the characters of `word` within one line.
+
+    The characters must appear in order, with anything but a line break
+    between them, in `text[start:end]`. Returns a list of their offsets in
+    the first line that has them all, or None. `text` can be a str, bytes
+    or an mmap, with `word` a sequence of str or bytes to match.
+
+    The first occurrence of the word's first character in a line is the
+    best place to start matching it there, so each line is scanned once:
+    a regex with lazy gaps backtracks through the whole line from every
+    occurrence of the first character.
+
+    """
+    if end is None:
+        end = len(text)
+    if not word:
+        return []
+    first, rest = word[0], word[1:]
+    while start < end:
+        position = text.find(first, start, end)
+        if position == -1:
+            return None
+        line_end = text.find(newline, position, end)
+        if line_end == -1:
+            line_end = end
+        offsets = [position]
+        position += len(first)
+        for character in rest:
+            position = text.find(character, position, line_end)
+            if position == -1:
+                break
+            offsets.append(position)
+            position += len(character)
+        else:
+            return offsets
+        start = line_end + 1
+    return None
+
+
+def scan_file(abspath, search_word, lines=False):
+    """Return True if the file at `abspath` contains `search_word`.
+
+    The file is memory-mapped and its UTF-8 bytes are searched directly:
+    exactly for words with uppercase letters and ASCII case-insensitively
+    for lowercase ASCII words, a chunk at a time. Lowercase words must be
+    given as their tv_query.word_key(), and are otherwise looked for in the
+    search key of the decoded file, as they are when an ASCII word isn't
+    found in a file that isn't all ASCII.
+
+    If `lines` is True, the characters of the word may be separated by
+    anything but a line break, see line_subsequence().
+
+    """
+    with open(abspath, 'rb') as fp:
+        try:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped.
+            return False
+    with mapped:
+        lower = search_word.islower()
+        if not lower:
+            if not lines:
+                return mapped.find(search_word.encode('utf-8')) != -1
+            return line_subsequence(
+                mapped, [character.encode('utf-8')
+                         for character in search_word], b'\n') is not None
+        if not tv_query.ignore_accents and search_word.isascii():
+            if _scan_ascii(mapped, search_word, lines):
+                return True
+            # Lowercasing the ASCII letters only misses the matches that
+            # other characters fold into ("ß" to "ss").
+            if tv_query.ascii_folding_bytes().search(mapped) is None:
+                return False
+        contents = tv_query.search_key(
+            mapped[:].decode('utf-8', errors='ignore'))
+        if not lines:
+            return search_word in contents
+        return line_subsequence(contents, search_word) is not None
+
+
+def _scan_ascii(mapped, search_word, lines):
+    """Look for a lowercase ASCII word in mapped bytes, ignoring case."""
+    # bytes.lower() only folds ASCII letters.
+    word = search_word.encode('utf-8')
+    size = len(mapped)
+    if lines:
+        # Chunks end at line breaks, so that no line is split between them.
+        characters = [word[i:i + 1] for i in range(len(word))]
+        start = 0
+        while start < size:
+            end = min(size, start + SCAN_CHUNK_BYTES)
+            if end < size:
+                line_break = mapped.rfind(b'\n', start, end)
+                if line_break == -1:
+                    line_break = mapped.find(b'\n', end)
+                end = size if line_break == -1 else line_break + 1
+            chunk = mapped[start:end].lower()
+            if line_subsequence(chunk, characters, b'\n') is not None:
+                return True
+            start = end
+        return False
+    # Chunks overlap so that matches across their boundaries are found.
+    overlap = len(word) - 1
+    for start in range(0, size, SCAN_CHUNK_BYTES):
+        chunk = mapped[start:start + SCAN_CHUNK_BYTES + overlap]
+        if word in chunk.lower():
+            return True
+    return False
+
+
 class PlainTextNote(object):
-    """A note, stored as a plain text file on disk."""
+    """A note, stored as a plain text file on disk.
+
+    Notes are kept compact for large notebooks: they have no instance
+    dicts, share their title and path strings with the notebook's
+    registries, and keep only the stat signature of their file. Making a
+    note doesn't touch the file system.
+
+    """
+
+    __slots__ = ('_title', '_title_nfc', '_title_key', '_notebook',
+                 '_extension', '_abspath', 'signature')
 
-    def __init__(self, title, notebook, extension):
-        """Initialise a new PlainTextNote."""
+    def __init__(self, title, notebook, extension, abspath=None):
+        """Initialise a new PlainTextNote.
+
+        `abspath` may be given to share an existing string, it must be the
+        path of the note's file.
+
+        """
         self._title = title
+        self._title_nfc = None
+        self._title_key = None
         self._notebook = notebook
         self._extension = extension
-        self._filename = self.title + self._extension
-        self._abspath = os.path.join(self._notebook.path, self._filename)
-        directory = os.path.split(self.abspath)[0]
-        if not os.path.isdir(directory):
-            message = '\'{} doesn\'t exist, creating it'
-            logger.debug(message.format(directory))
-            try:
-                os.makedirs(directory)
-            except os.error as e:
-                message = '{} could not be created: {}'
-                raise NewNoteError(message.format(directory, e))
+        if abspath is None:
+            abspath = os.path.join(notebook.path, title + extension)
+        self._abspath = abspath
+        # The ContentCache.signature() of the file from when the note was
+        # loaded or last changed, if known.
+        self.signature = None
 
     @property
     def title(self):
@@ -81,51 +526,287 @@ class PlainTextNote(object):
     def set_title(self, new_title):
         raise NotImplementedError
 
+    @property
+    def title_nfc(self):
+        """The title normalized to NFC, like the contents and search words.
+
+        Filenames can be decomposed (NFD), as they are on macOS, so words
+        with capitals are matched against this rather than the title.
+
+        """
+        if self._title_nfc is None:
+            self._title_nfc = unicodedata.normalize('NFC', self._title)
+        return self._title_nfc
+
+    @property
+    def title_key(self):
+        """The tv_query.search_key() of the title, made when first needed."""
+        if self._title_key is None:
+            key = tv_query.search_key(self._title)
+            self._title_key = self._title if key == self._title else key
+        return self._title_key
+
     @property
     def extension(self):
         return self._extension
 
+    @property
+    def filename(self):
+        return self._title + self._extension
+
     @property
     def contents(self):
-        with open(self.abspath, 'rb') as fp:
-            contents = fp.read()
-        if contents is None:
-            message = 'Could not decode file contents: {}'
-            logger.error(message.format(self.abspath))
-            return ''
-        else:
-            return contents.decode('utf-8', errors='ignore')
+        """The contents, read through the notebook's ContentCache.
+
+        Large notes are read from disk every time instead of filling the
+        cache.
+
+        """
+        if self.is_large:
+            with open(self.abspath, 'rb') as fp:
+                return decode_note(fp.read())
+        return self._notebook.content_cache.get(
+            self.abspath, self.signature)[0]
+
+    @property
+    def contents_key(self):
+        """The tv_query.search_key() of the contents."""
+        if self.is_large:
+            return tv_query.search_key(self.contents)
+        return self._notebook.content_cache.get(
+            self.abspath, self.signature)[1]
+
+    def _signature(self):
+        if self.signature is None:
+            self.signature = ContentCache.signature(os.stat(self.abspath))
+        return self.signature
+
+    @property
+    def is_large(self):
+        """True if the note is too big to be decoded, cached or indexed."""
+        return self._signature()[1] > self._notebook.max_note_size
+
+    def contains(self, search_word):
+        """Return True if the contents contain `search_word`.
+
+        The word must be a tv_query.word_key(): lowercase words are looked
+        for in the contents' search key, others in the contents. Large
+        notes are scanned on disk by scan_file().
+
+        """
+        if self.is_large:
+            return scan_file(self.abspath, search_word)
+        if search_word.islower():
+            return search_word in self.contents_key
+        return search_word in self.contents
 
     @property
     def mtime(self):
-        return os.path.getmtime(self.abspath)
+        return self._signature()[0] / 1e9
 
     @property
     def abspath(self):
         return self._abspath
 
+    @property
+    def notebook(self):
+        """The PlainTextNoteBook of the notes directory holding this note."""
+        return self._notebook
+
     def __eq__(self, other):
         return getattr(other, 'abspath', None) == self.abspath
 
 
 def brute_force_search(notebook, query):
     """Return all notes in `notebook` that match `query`."""
-    search_words = query.strip().split()
-    matching_notes = []
+    return list(iter_brute_force_search(notebook, query))
+
+
+def iter_brute_force_search(notebook, query):
+    """Yield the notes in `notebook` that match `query` as they're found.
+
+    The query is compiled with tv_query.compile_query(), see tv_query for
+    the query language.
+
+    """
+    matches = tv_query.compile_query(query).matches
     for note in notebook:
-        match = True
-        for search_word in search_words:
-            if search_word.islower():
-                in_title = search_word in note.title.lower()
-                in_contents = search_word in note.contents.lower()
+        if matches(note):
+            yield note
+
+
+def relevance(note, search_words, now):
+    """Return how relevant `note` is to a query split into `search_words`.
+
+    Words found in the title score most, more so at the start of the title
+    or of a word in it. Each word also scores by how often it occurs in the
+    contents, and newer notes get a bonus that halves over about a week.
+    Words are matched with the same smart case as brute_force_search. Large
+    notes aren't read into memory, so their contents only score for
+    containing a word at all.
+
+    """
+    score = 0.0
+    large = note.is_large
+    for search_word in search_words:
+        lower = search_word.islower()
+        search_word = tv_query.word_key(search_word)
+        title = note.title_key if lower else note.title_nfc
+        if search_word in title:
+            score += 10.0
+            if (title.startswith(search_word)
+                    or ' ' + search_word in title
+                    or os.sep + search_word in title):
+                score += 5.0
+        if large:
+            count = 1 if note.contains(search_word) else 0
+        elif lower:
+            count = note.contents_key.count(search_word)
+        else:
+            count = note.contents.count(search_word)
+        score += math.log1p(count)
+    age_in_days = max(0.0, now - note.mtime) / 86400
+    return score + 3.0 / (1 + age_in_days / 7)
+
+
+class RankedResults(collections.abc.Sequence):
+    """A sequence of notes in order of relevance to a query.
+
+    Only the `k` most relevant notes are selected up front, using a bounded
+    heap. The rest are put in order lazily, as positions past them are
+    asked for. Notes with equal scores keep their order in `notes`.
+
+    Notes are scored with `score(note, search_words, now)`, by default
+    relevance().
+
+    """
+
+    def __init__(self, notes, query, k=50, score=relevance):
+        search_words = tv_query.search_words(query)
+        now = time.time()
+        self._scored = [
+            (-score(note, search_words, now), position, note)
+            for position, note in enumerate(notes)]
+        self._ranked = heapq.nsmallest(k, self._scored)
+        self._rest = None
+        self._abspaths = None
+
+    def _rank(self, count):
+        """Make sure at least the first `count` notes are in order."""
+        if count <= len(self._ranked):
+            return
+        if self._rest is None:
+            taken = {entry[1] for entry in self._ranked}
+            self._rest = [entry for entry in self._scored
+                          if entry[1] not in taken]
+            heapq.heapify(self._rest)
+        while len(self._ranked) < count and self._rest:
+            self._ranked.append(heapq.heappop(self._rest))
+
+    def __len__(self):
+        return len(self._scored)
+
+    def __contains__(self, note):
+        # Sequence.__contains__ would rank every note looking for it.
+        if self._abspaths is None:
+            self._abspaths = {entry[2].abspath for entry in self._scored}
+        return getattr(note, 'abspath', None) in self._abspaths
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        self._rank(index + 1)
+        return self._ranked[index][2]
+
+
+def match_offsets(note, search_words, limit=20):
+    """Return the (start, end) offsets of `search_words` in note.contents.
+
+    Words are matched with the same smart case as brute_force_search, and
+    at most `limit` occurrences of each word are found. The offsets are in
+    order.
+
+    """
+    offsets = []
+    text, text_key = note.contents, note.contents_key
+    # Offsets in the search key are mapped back to offsets in the text.
+    to_text = tv_query.key_offsets(text, text_key)
+    for search_word in search_words:
+        key = tv_query.word_key(search_word)
+        folded = search_word.islower()
+        contents = text_key if folded else text
+        start = contents.find(key)
+        for _ in range(limit):
+            if start == -1:
+                break
+            end = start + len(key)
+            if folded and to_text is not None:
+                offsets.append((to_text(start), to_text(end - 1) + 1))
             else:
-                in_title = search_word in note.title
-                in_contents = search_word in note.contents
-            if (not in_title) and (not in_contents):
-                match = False
-        if match:
-            matching_notes.append(note)
-    return matching_notes
+                offsets.append((start, end))
+            start = contents.find(key, end)
+    offsets.sort()
+    return offsets
+
+
+def snippet(note, search_words, offsets=match_offsets, width=60):
+    """Return a one-line snippet of `note` around its first match.
+
+    `offsets(note, search_words)` gives the matches' offsets in the note's
+    contents, by default match_offsets(). Returns (text, highlights), where
+    highlights are the (start, end) offsets of the matches within text.
+    Large notes and notes without matches in their contents have an empty
+    snippet.
+
+    """
+    if not search_words or note.is_large:
+        return '', []
+    matches = offsets(note, search_words)
+    if not matches:
+        return '', []
+    contents = note.contents
+    anchor = matches[0][0]
+    line_start = contents.rfind('\n', 0, anchor) + 1
+    line_end = contents.find('\n', anchor)
+    if line_end == -1:
+        line_end = len(contents)
+    while line_start < anchor and contents[line_start] in ' \t':
+        line_start += 1
+    start = max(line_start, anchor - width // 3)
+    if start > line_start:
+        # Start at a word if there's one before the match.
+        space = contents.find(' ', start, anchor)
+        if space != -1:
+            start = space + 1
+    end = min(line_end, start + width)
+    text = contents[start:end].replace('\t', ' ').replace('\r', ' ')
+    highlights = [(max(match_start, start) - start, min(match_end, end) - start)
+                  for match_start, match_end in matches
+                  if match_start < end and match_end > start]
+    if start > line_start:
+        text = '\u2026' + text
+        highlights = [(a + 1, b + 1) for a, b in highlights]
+    if end < line_end:
+        text += '\u2026'
+    return text, highlights
+
+
+def is_refinement(old_query, new_query):
+    """Return True if every match for `new_query` also matches `old_query`.
+
+    This holds for brute_force_search when every clause of the old query
+    is implied by a clause of the new one, for example when each word of
+    the old query is a substring of some word of the new query: a note
+    containing the longer word contains the shorter one in the same place.
+    See tv_query.Term.implies().
+
+    """
+    return tv_query.compile_query(new_query).implies(
+        tv_query.compile_query(old_query))
 
 
 class PlainTextNoteBook(object):
@@ -138,9 +819,48 @@ class PlainTextNoteBook(object):
             extensions,
             search_function=brute_force_search,
             exclude=None,
+            cache_bytes=DEFAULT_CACHE_BYTES,
+            scan_workers=None,
+            event_delay=0.1,
+            max_note_size=DEFAULT_MAX_NOTE_SIZE,
+            result_cache_size=DEFAULT_RESULT_CACHE_SIZE,
+            watch=True,
+            load=True,
+            content_cache=None,
+            name=None,
+            exclude_paths=(),
     ):
-        """Make a new PlainTextNoteBook for the given path."""
+        """Make a new PlainTextNoteBook for the given path.
+
+        Unless `watch` is False the notes directory is watched for changes
+        by a watchdog observer thread. If `load` is False the notebook
+        starts out empty, and load() must be called, perhaps on another
+        thread.
+
+        Notes bigger than `max_note_size` bytes are searched on disk rather
+        than decoded into the content cache and indexed. The results of the
+        last `result_cache_size` queries are kept until a note changes.
+
+        The notes directory is scanned by a pool of `scan_workers` threads
+        (by default the ThreadPoolExecutor default). File system events
+        that arrive within `event_delay` seconds of each other are applied
+        together.
+
+        A MultiRootNoteBook passes the `content_cache` shared by its roots,
+        the root's `name` and, in `exclude_paths`, the absolute paths of
+        any other roots inside this one, whose notes it leaves to them.
+
+        """
         self._path = os.path.abspath(os.path.expanduser(path))
+        # What the abspaths of notes start with, for making their titles.
+        self._prefix = os.path.join(self._path, '')
+        if content_cache is None:
+            content_cache = ContentCache(cache_bytes)
+        self.content_cache = content_cache
+        self.result_cache = ResultCache(result_cache_size)
+        self.name = name
+        self.exclude_paths = frozenset(exclude_paths)
+        self.max_note_size = max_note_size
         if extension and not extension.startswith('.'):
             extension = '.' + extension
         self.extension = extension
@@ -161,115 +881,879 @@ class PlainTextNoteBook(object):
             except os.error as e:
                 message = '{} could not be created: {}'
                 raise NewNoteBookError(message.format(self.path, e))
-        self._notes = []
-        for root, dirs, files in os.walk(self.path):
-            for name in self.exclude:
-                if name in dirs:
-                    dirs.remove(name)
-            for filename in files:
-                    self.add_new(filename, root=root)
-        # Activate watchdog
+        # The notes by abspath and by (title, extension), and a sorted list
+        # of their recency keys, most recently modified first.
+        self._notes = {}
+        self._titles = {}
+        self._recency = []
+        self._recency_keys = {}
+        self._title_index = TitleIndex()
+        self._lock = threading.RLock()
+        self._listeners = []
+        # Incremented whenever a note is added, removed or changed.
+        self.generation = 0
+        self._last_search = None
+        # Set once all of the notes have been loaded.
+        self.loaded = threading.Event()
+        self.scan_workers = scan_workers
+        self.event_delay = event_delay
+        self._observer = None
+        if load:
+            self.load(watch=watch)
+
+    def load(self, watch=True, batch_size=None):
+        """Load the notes, attach the search function and start watching.
+
+        With a `batch_size` notes are added in batches of about that many
+        as directories are scanned, and listeners' notes_changed() is called
+        after each batch. Until the search function has been attached,
+        search() falls back to brute force over the notes loaded so far.
+
+        """
+        with tv_stats.stats.timer('load'):
+            self._load(self.scan_workers, batch_size)
+            attach = getattr(self.search_function, 'attach', None)
+            if attach is not None:
+                attach(self)
+        if watch:
+            self.watch()
+        self.loaded.set()
+        if batch_size:
+            self._notify('notes_changed')
+        else:
+            self.generation += 1
+
+    def watch(self):
+        """Start watching the notes directory for changes."""
+        # watchdog takes a while to import, so it's only imported once it's
+        # needed.
+        from watchdog.observers import Observer
         self._observer = Observer()
-        self._fileEventHandler = FileEventHandler(self)
+        self._fileEventHandler = FileEventHandler(self, delay=self.event_delay)
         self._observer.schedule(self._fileEventHandler, self.path, recursive=True)
         self._observer.start()
 
+    def stop_watching(self):
+        """Stop watching the notes directory, dropping any queued changes."""
+        if self._observer is None:
+            return
+        self._observer.stop()
+        self._observer.join()
+        self._fileEventHandler.cancel()
+        self._observer = None
+
     @property
     def path(self):
         return self._path
 
     def search(self, query):
-        """Return a sequence of Notes that match the given query."""
-        return self.search_function(self, query)
+        """Return a list of the Notes that match the given query.
 
-    def add_new(self, filename, root=None):
+        The notes are in the order of iteration over this notebook, most
+        recently modified first. Results are reused from the result cache
+        if no notes have changed since the query was last searched for.
+        Otherwise, if `query` refines the previous query and no notes have
+        changed since, only the previous query's matches are searched.
+
+        """
+        generation = self.generation
+        matching_notes = self.result_cache.get(query, generation)
+        if matching_notes is None:
+            matching_notes = self._search(query, generation)
+            self.result_cache.put(query, generation, matching_notes)
+        self._last_search = (generation, query, matching_notes)
+        logger.debug('Result cache: {}'.format(self.result_cache))
+        return list(matching_notes)
+
+    def _search(self, query, generation):
+        refines = getattr(
+            self.search_function, 'is_refinement', is_refinement)
+        last_search = self._last_search
+        if (last_search is not None and last_search[0] == generation
+                and refines(last_search[1], query)):
+            logger.debug('Refining {} matches for {!r}'.format(
+                len(last_search[2]), last_search[1]))
+            with tv_stats.stats.timer('search'):
+                matching_notes = self.search_function(last_search[2], query)
+        else:
+            with tv_stats.stats.timer('search'):
+                matching_notes = self.search_function(self, query)
+        logger.debug('Content cache: {}'.format(self.content_cache))
+        return tuple(matching_notes)
+
+    def iter_search(self, query):
+        """Yield the Notes that match the given query as they're found.
+
+        The notes come in the same order as from search(). Search functions
+        with an iterate(notebook, query) method stream their matches, others
+        are called once and their results yielded.
+
+        """
+        iterate = getattr(self.search_function, 'iterate', None)
+        if iterate is None and self.search_function is brute_force_search:
+            iterate = iter_brute_force_search
+        if iterate is None:
+            matching_notes = self.search(query)
+        else:
+            matching_notes = iterate(self, query)
+        for note in matching_notes:
+            yield note
+
+    def _is_note_filename(self, filename):
+        """Return True if a file with this name should be a note."""
         if filename in self.exclude:
-            return None
+            return False
         if filename.startswith('.') or filename.endswith('~'):
+            return False
+        return os.path.splitext(filename)[1] in self.extensions
+
+    def _title_for(self, abspath):
+        """Return the (title, extension) of the note stored at `abspath`."""
+        if abspath.startswith(self._prefix):
+            title = abspath[len(self._prefix):]
+        else:
+            title = os.path.relpath(abspath, self.path)
+        title, extension = os.path.splitext(title)
+        if title.startswith(os.sep):
+            title = title[len(os.sep):]
+        return title.strip(), sys.intern(extension)
+
+    def _scan_directory(self, directory):
+        """Return the note files and subdirectories directly in `directory`.
+
+        Note files are returned as (abspath, stat_result) pairs, using the
+        stat results cached by os.scandir().
+
+        """
+        files = []
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            if (entry.name not in self.exclude
+                                    and not entry.is_symlink()
+                                    and entry.path not in self.exclude_paths):
+                                subdirectories.append(entry.path)
+                        elif self._is_note_filename(entry.name):
+                            files.append((entry.path, entry.stat()))
+                    except OSError as e:
+                        logger.error('Could not scan {}: {}'.format(
+                            entry.path, e))
+        except OSError as e:
+            logger.error('Could not scan {}: {}'.format(directory, e))
+        return files, subdirectories
+
+    def _is_excluded(self, abspath):
+        """Return True if `abspath` is in a directory that isn't scanned."""
+        directory = os.path.dirname(os.path.relpath(abspath, self.path))
+        if any(name in self.exclude for name in directory.split(os.sep)):
+            return True
+        return any(abspath.startswith(os.path.join(path, ''))
+                   for path in self.exclude_paths)
+
+    def _scan(self, workers=None, root=None):
+        """Return (abspath, stat_result) pairs for all note files on disk.
+
+        Directories are listed concurrently by a thread pool, starting from
+        `root` (by default the notes directory).
+
+        """
+        found = []
+        for files in self._iter_scan(workers, root):
+            found.extend(files)
+        found.sort()
+        return found
+
+    def _iter_scan(self, workers=None, root=None):
+        """Yield lists of (abspath, stat_result) pairs as they're scanned.
+
+        Each list holds the note files directly in one directory.
+
+        """
+        if root is None:
+            root = self.path
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            pending = {executor.submit(self._scan_directory, root)}
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    files, subdirectories = future.result()
+                    for subdirectory in subdirectories:
+                        pending.add(executor.submit(
+                            self._scan_directory, subdirectory))
+                    yield files
+
+    def _load(self, scan_workers=None, batch_size=None):
+        """Add a note for every note file in the notes directory.
+
+        Unlike add_new() this neither touches the files nor checks each
+        note against all of the others. See load() for `batch_size`.
+
+        """
+        start = time.perf_counter()
+        if not batch_size:
+            found = self._scan(scan_workers)
+            scanned = time.perf_counter()
+            self._load_files(found)
+            logger.debug('Scanned {} files in {:.3f}s, loaded {} notes in '
+                         '{:.3f}s'.format(len(found), scanned - start,
+                                          len(self._notes),
+                                          time.perf_counter() - scanned))
+            return
+        batch = []
+        for files in self._iter_scan(scan_workers):
+            batch.extend(files)
+            if len(batch) >= batch_size:
+                self._load_files(sorted(batch))
+                self._notify('notes_changed')
+                batch = []
+        self._load_files(sorted(batch))
+        logger.debug('Loaded {} notes in batches in {:.3f}s'.format(
+            len(self._notes), time.perf_counter() - start))
+
+    def _load_files(self, found):
+        """Add notes for a sorted list of (abspath, stat_result) pairs."""
+        with self._lock:
+            for abspath, stat_result in found:
+                title, extension = self._title_for(abspath)
+                if (not os.path.split(title)[1]
+                        or (title, extension) in self._titles):
+                    logger.debug('Skipping {}'.format(abspath))
+                    continue
+                note = PlainTextNote(title, self, extension, abspath)
+                note.signature = ContentCache.signature(stat_result)
+                self._register(note, ordered=False)
+            self._recency.sort()
+            self._title_index.sort()
+
+    def add_listener(self, listener):
+        """Register `listener` to be told when notes change.
+
+        The listener's note_added(note), note_removed(note) and
+        note_changed(note) methods are called after the corresponding change
+        to this notebook.
+
+        """
+        self._listeners.append(listener)
+
+    @staticmethod
+    def _recency_key(note):
+        mtime_ns = note.signature[0] if note.signature else 0
+        return (-mtime_ns, note.abspath)
+
+    def _register(self, note, ordered=True):
+        """Add `note` to the registries.
+
+        If not `ordered` the caller must sort self._recency afterwards.
+
+        """
+        key = self._recency_key(note)
+        with self._lock:
+            self._notes[note.abspath] = note
+            self._titles[(note.title, note.extension)] = note
+            self._recency_keys[note.abspath] = key
+            if ordered:
+                bisect.insort(self._recency, key)
+            else:
+                self._recency.append(key)
+            self._title_index.add(note, key, ordered)
+
+    def _unregister(self, note):
+        with self._lock:
+            del self._notes[note.abspath]
+            del self._titles[(note.title, note.extension)]
+            key = self._recency_keys.pop(note.abspath)
+            del self._recency[bisect.bisect_left(self._recency, key)]
+            self._title_index.remove(note)
+
+    def _set_stat(self, note, stat_result):
+        """Update a note's stat signature and its place by recency."""
+        with self._lock:
+            note.signature = ContentCache.signature(stat_result)
+            key = self._recency_key(note)
+            old_key = self._recency_keys[note.abspath]
+            if key != old_key:
+                del self._recency[bisect.bisect_left(self._recency, old_key)]
+                bisect.insort(self._recency, key)
+                self._recency_keys[note.abspath] = key
+                self._title_index.update(note, key)
+
+    def complete_title(self, prefix, matches=None):
+        """Return the newest note whose title starts with `prefix`, or None.
+
+        Titles are compared by search key, and the note is found in time
+        logarithmic in the number of notes. If `matches` is given, the
+        newest such note for which matches(note) is True is returned.
+
+        """
+        with self._lock:
+            if matches is None:
+                key = self._title_index.first(prefix)
+                return None if key is None else self._notes[key[1]]
+            for key in self._title_index.newest(prefix):
+                note = self._notes[key[1]]
+                if matches(note):
+                    return note
             return None
-        if os.path.splitext(filename)[1] not in self.extensions:
+
+    def by_recency(self, notes):
+        """Return `notes` sorted most recently modified first.
+
+        Uses the stat results cached when notes were loaded or changed.
+
+        """
+        keys = self._recency_keys
+        return sorted(notes, key=lambda note: keys.get(
+            note.abspath, (0, note.abspath)))
+
+    def _notify(self, event, *args):
+        self.generation += 1
+        for listener in self._listeners:
+            method = getattr(listener, event, None)
+            if method is not None:
+                method(*args)
+
+    def apply_changes(self, paths):
+        """Bring the notes up to date with changes to the given paths.
+
+        `paths` maps each changed path to True if it is (or was) a
+        directory. Every path is checked against the file system, so it
+        doesn't matter which events were seen for it or in what order.
+        Listeners' note_added(), note_removed() and note_changed() are
+        called for each affected note and then notes_changed() is called
+        once for the whole batch.
+
+        """
+        changed = False
+        with self._lock:
+            for path, is_directory in sorted(paths.items()):
+                if is_directory or os.path.isdir(path):
+                    changed = self._apply_directory(path) or changed
+                else:
+                    changed = self._apply_file(path) or changed
+        if changed:
+            self._notify('notes_changed')
+        return changed
+
+    def _apply_directory(self, path):
+        prefix = os.path.join(path, '')
+        found = {}
+        if os.path.isdir(path) and not self._is_excluded(prefix):
+            found = dict(self._scan(root=path))
+        changed = False
+        for abspath in [abspath for abspath in self._notes
+                        if abspath.startswith(prefix)
+                        and abspath not in found]:
+            changed = self._apply_file(abspath, None) or changed
+        for abspath, stat_result in sorted(found.items()):
+            changed = self._apply_file(abspath, stat_result) or changed
+        return changed
+
+    def _apply_file(self, abspath, stat_result=False):
+        """Add, remove or update the note for `abspath` to match the disk.
+
+        `stat_result` is the file's os.stat() result, None if it doesn't
+        exist, or False to stat it now.
+
+        """
+        if stat_result is False:
+            try:
+                stat_result = os.stat(abspath)
+            except OSError:
+                stat_result = None
+        note = self.get(abspath)
+        if stat_result is None:
+            if note is None:
+                return False
+            logger.debug("Removing {}".format(abspath))
+            self._unregister(note)
+            self.content_cache.discard(note.abspath)
+            self._notify('note_removed', note)
+            return True
+        if note is None:
+            if (not self._is_note_filename(os.path.basename(abspath))
+                    or self._is_excluded(abspath)):
+                return False
+            title, extension = self._title_for(abspath)
+            if (not os.path.split(title)[1]
+                    or (title, extension) in self._titles):
+                return False
+            logger.debug("Adding {}".format(abspath))
+            note = PlainTextNote(title, self, extension, abspath)
+            note.signature = ContentCache.signature(stat_result)
+            self._register(note)
+            self._notify('note_added', note)
+            return True
+        if note.signature == ContentCache.signature(stat_result):
+            return False
+        logger.debug("Updating {}".format(abspath))
+        self._set_stat(note, stat_result)
+        self._notify('note_changed', note)
+        return True
+
+    def add_new(self, filename, root=None):
+        """Create a new Note and add it to this NoteBook."""
+        if not self._is_note_filename(filename):
             return None
         if root is None:
             root = self._path
         logger.debug("Creating filename: {}".format(filename))
         abspath = os.path.join(root, filename)
-        with open(abspath, 'a') as fp:
-            fp.write("")
-        title = os.path.relpath(abspath, self.path)
-        title, extension = os.path.splitext(title)
-        if title is None:
-            message = 'Could not decode filename: {}'
-            logger.error(message.format(title))
-            return None
-
-        """Create a new Note and add it to this NoteBook."""
-        if extension is None:
-            extension = self.extension
-        if title.startswith(os.sep):
-            title = title[len(os.sep):]
-        title = title.strip()
-        if not os.path.split(title)[1]:
-            message = 'Invalid note title: {}'
-            raise InvalidNoteTitleError(message.format(title))
-        for note in self._notes:
-            if note.title == title and note.extension == extension:
+        directory = os.path.dirname(abspath)
+        if not os.path.isdir(directory):
+            message = '\'{} doesn\'t exist, creating it'
+            logger.debug(message.format(directory))
+            try:
+                os.makedirs(directory)
+            except os.error as e:
+                message = '{} could not be created: {}'
+                raise NewNoteError(message.format(directory, e))
+        with self._lock:
+            with open(abspath, 'a') as fp:
+                fp.write("")
+            title, extension = self._title_for(abspath)
+            if not extension:
+                extension = self.extension
+            if not os.path.split(title)[1]:
+                message = 'Invalid note title: {}'
+                raise InvalidNoteTitleError(message.format(title))
+            if (title, extension) in self._titles:
                 message = 'Note already in NoteBook: {}'
-                raise NoteAlreadyExistsError(message.format(note.title))
-        note = PlainTextNote(title, self, extension)
-        self._notes.append(note)
+                raise NoteAlreadyExistsError(message.format(title))
+            note = PlainTextNote(title, self, extension, abspath)
+            note.signature = ContentCache.signature(os.stat(abspath))
+            self._register(note)
+            self._notify('note_added', note)
         return note
 
-    def remove(self, filename, root=None):
-        logger.debug("Removing {}".format(filename))
+    def get(self, filename, root=None):
+        """Return the note stored in the given file, or None."""
         if root is None:
             root = self._path
         abspath = os.path.join(root, filename)
-        title = os.path.relpath(abspath, self.path)
-        title, _ = os.path.splitext(title)
-        if title is None:
-            message = 'Could not decode filename: {}'
-            logger.error(message.format(title))
-            return
-        for i in range(len(self._notes)):
-            n = self._notes[i]
-            if n.title == title:
-                logger.debug("Found note with index {} and title {}".format(i, title))
-                logger.debug("Current length is {}".format(len(self._notes)))
-                self._notes = self._notes[:i] + self._notes[i+1:]
-                logger.debug("New length is {}".format(len(self._notes)))
+        note = self._notes.get(abspath)
+        if note is None:
+            note = self._titles.get(self._title_for(abspath))
+        return note
+
+    def remove(self, filename, root=None):
+        logger.debug("Removing {}".format(filename))
+        with self._lock:
+            note = self.get(filename, root=root)
+            if note is None:
                 return
+            self._unregister(note)
+            self.content_cache.discard(note.abspath)
+            logger.debug("New length is {}".format(len(self._notes)))
+            self._notify('note_removed', note)
+
+    def update(self, filename, root=None):
+        """Tell this notebook that the file for a note has been modified.
+
+        Returns the note, or None if its file has gone and the note has
+        been removed.
+
+        """
+        with self._lock:
+            note = self.get(filename, root=root)
+            if note is not None:
+                try:
+                    stat_result = os.stat(note.abspath)
+                except OSError:
+                    self._apply_file(note.abspath, None)
+                    return None
+                logger.debug("Updating {}".format(note.abspath))
+                self._set_stat(note, stat_result)
+                self._notify('note_changed', note)
+        return note
 
     def __len__(self):
         return len(self._notes)
 
+    def _snapshot(self):
+        with self._lock:
+            notes = self._notes
+            return [notes[abspath] for _, abspath in self._recency]
+
     def __getitem__(self, index):
-        return self._notes[index]
+        return self._snapshot()[index]
 
     def __delitem__(self, index):
         raise NotImplementedError
 
     def __iter__(self):
-        return self._notes.__iter__()
+        # Iterate most recently modified first over a snapshot, notes may be
+        # added or removed by the watchdog thread meanwhile.
+        return iter(self._snapshot())
+
+    def __reversed__(self):
+        return reversed(self._snapshot())
+
+    def __contains__(self, note):
+        return getattr(note, 'abspath', None) in self._notes
+
+def root_names(paths):
+    """Return a short name for each of the notes directories in `paths`.
+
+    Directories are named after their last component, with more of their
+    path where that isn't enough to tell them apart.
+
+    """
+    names = [os.path.basename(path.rstrip(os.sep)) or path for path in paths]
+    home = os.path.join(os.path.expanduser('~'), '')
+    for index, name in enumerate(names):
+        if names.count(name) > 1:
+            path = paths[index]
+            if path.startswith(home):
+                path = os.path.join('~', path[len(home):])
+            names[index] = path
+    return names
+
+
+class MultiRootNoteBook(object):
+    """A notebook spanning several notes directories.
+
+    Each directory, or root, is loaded and watched, by its own observer, as
+    a PlainTextNoteBook with the root's name (see root_names()), and the
+    roots share a content cache. Notes belong to the innermost root that
+    holds them, so roots inside other roots, and roots given twice, don't
+    give duplicate notes.
+
+    This has the notebook interface that the user interface and the search
+    functions use, and iterates over the notes of all of the roots most
+    recently modified first. A search function with an attach() method is
+    attached to the whole notebook, so an index is shared by all of the
+    roots. Other search functions search each root's notes concurrently
+    and their matches are merged in recency order. New notes are added to
+    the first root.
+
+    """
+
+    def __init__(
+            self,
+            paths,
+            extension,
+            extensions,
+            search_function=brute_force_search,
+            exclude=None,
+            cache_bytes=DEFAULT_CACHE_BYTES,
+            scan_workers=None,
+            event_delay=0.1,
+            max_note_size=DEFAULT_MAX_NOTE_SIZE,
+            result_cache_size=DEFAULT_RESULT_CACHE_SIZE,
+            watch=True,
+            load=True,
+    ):
+        """Make a notebook for the notes directories in `paths`.
+
+        The other arguments are as for PlainTextNoteBook.
+
+        """
+        roots = []
+        for path in paths:
+            path = os.path.realpath(os.path.expanduser(path))
+            if path not in roots:
+                roots.append(path)
+        self.content_cache = ContentCache(cache_bytes)
+        self.result_cache = ResultCache(result_cache_size)
+        self.max_note_size = max_note_size
+        self.search_function = search_function
+        self.notebooks = []
+        for root, name in zip(roots, root_names(roots)):
+            nested = [other for other in roots
+                      if other.startswith(os.path.join(root, ''))]
+            notebook = PlainTextNoteBook(
+                root, extension, extensions, exclude=exclude,
+                scan_workers=scan_workers, event_delay=event_delay,
+                max_note_size=max_note_size, load=False,
+                content_cache=self.content_cache, name=name,
+                exclude_paths=nested)
+            notebook.add_listener(self)
+            self.notebooks.append(notebook)
+        self.extension = self.notebooks[0].extension
+        # What the search index store is named after.
+        self.path = os.pathsep.join(roots)
+        self._listeners = []
+        self.generation = 0
+        self._last_search = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(len(roots))
+        self.loaded = threading.Event()
+        if load:
+            self.load(watch=watch)
+
+    def load(self, watch=True, batch_size=None):
+        """Load each root's notes, then attach the search function.
+
+        See PlainTextNoteBook.load().
+
+        """
+        with tv_stats.stats.timer('load'):
+            for notebook in self.notebooks:
+                notebook.load(watch=False, batch_size=batch_size)
+            attach = getattr(self.search_function, 'attach', None)
+            if attach is not None:
+                attach(self)
+        # Only once the search function is listening, so that it sees every
+        # change made while it was being attached.
+        if watch:
+            self.watch()
+        self.loaded.set()
+        if batch_size:
+            self._notify('notes_changed')
+        else:
+            self.generation += 1
+
+    def watch(self):
+        for notebook in self.notebooks:
+            notebook.watch()
+
+    def stop_watching(self):
+        for notebook in self.notebooks:
+            notebook.stop_watching()
+
+    def add_listener(self, listener):
+        """Register `listener`, see PlainTextNoteBook.add_listener()."""
+        self._listeners.append(listener)
+
+    def _notify(self, event, *args):
+        self.generation += 1
+        for listener in self._listeners:
+            method = getattr(listener, event, None)
+            if method is not None:
+                method(*args)
+
+    # The roots' notebooks' changes are passed on to this one's listeners.
+
+    def note_added(self, note):
+        self._notify('note_added', note)
+
+    def note_removed(self, note):
+        self._notify('note_removed', note)
+
+    def note_changed(self, note):
+        self._notify('note_changed', note)
+
+    def notes_changed(self):
+        self._notify('notes_changed')
+
+    def search(self, query):
+        """Return a list of the Notes that match the given query.
+
+        See PlainTextNoteBook.search().
+
+        """
+        generation = self.generation
+        matching_notes = self.result_cache.get(query, generation)
+        if matching_notes is None:
+            matching_notes = self._search(query, generation)
+            self.result_cache.put(query, generation, matching_notes)
+        self._last_search = (generation, query, matching_notes)
+        logger.debug('Result cache: {}'.format(self.result_cache))
+        return list(matching_notes)
+
+    def _search(self, query, generation):
+        search_function = self.search_function
+        refines = getattr(search_function, 'is_refinement', is_refinement)
+        last_search = self._last_search
+        with tv_stats.stats.timer('search'):
+            if (last_search is not None and last_search[0] == generation
+                    and refines(last_search[1], query)):
+                matching_notes = search_function(last_search[2], query)
+            elif getattr(search_function, 'attach', None) is not None:
+                matching_notes = search_function(self, query)
+            else:
+                matches = self._executor.map(
+                    lambda notebook: search_function(notebook, query),
+                    self.notebooks)
+                matching_notes = heapq.merge(
+                    *matches, key=PlainTextNoteBook._recency_key)
+            return tuple(matching_notes)
+
+    def iter_search(self, query):
+        """Yield the Notes that match the given query as they're found.
+
+        See PlainTextNoteBook.iter_search().
+
+        """
+        iterate = getattr(self.search_function, 'iterate', None)
+        if iterate is None and self.search_function is brute_force_search:
+            iterate = iter_brute_force_search
+        if iterate is None:
+            matching_notes = self.search(query)
+        else:
+            matching_notes = iterate(self, query)
+        for note in matching_notes:
+            yield note
+
+    def complete_title(self, prefix, matches=None):
+        """Return the newest note whose title starts with `prefix`, or None.
+
+        See PlainTextNoteBook.complete_title().
+
+        """
+        notes = [notebook.complete_title(prefix, matches)
+                 for notebook in self.notebooks]
+        notes = [note for note in notes if note is not None]
+        if not notes:
+            return None
+        return min(notes, key=PlainTextNoteBook._recency_key)
+
+    def by_recency(self, notes):
+        """Return `notes` sorted most recently modified first."""
+        return sorted(notes, key=PlainTextNoteBook._recency_key)
+
+    def _notebook_for(self, root):
+        if root is None:
+            return self.notebooks[0]
+        root = os.path.realpath(os.path.expanduser(root))
+        for notebook in self.notebooks:
+            if notebook.path == root:
+                return notebook
+        raise ValueError('Not a notes directory of this notebook: ' + root)
+
+    def add_new(self, filename, root=None):
+        """Create a new Note in `root`, by default the first root."""
+        return self._notebook_for(root).add_new(filename)
+
+    def get(self, filename, root=None):
+        """Return the note stored in the given file, or None.
+
+        Without a `root` the roots are tried in order.
+
+        """
+        if root is not None:
+            return self._notebook_for(root).get(filename)
+        for notebook in self.notebooks:
+            note = notebook.get(filename)
+            if note is not None:
+                return note
+        return None
+
+    def remove(self, filename, root=None):
+        note = self.get(filename, root=root)
+        if note is not None:
+            note.notebook.remove(note.filename)
+
+    def update(self, filename, root=None):
+        """Tell this notebook that the file for a note has been modified.
+
+        See PlainTextNoteBook.update().
+
+        """
+        note = self.get(filename, root=root)
+        if note is not None:
+            note = note.notebook.update(note.filename)
+        return note
+
+    def __len__(self):
+        return sum(len(notebook) for notebook in self.notebooks)
+
+    def _snapshot(self):
+        return list(heapq.merge(
+            *[notebook._snapshot() for notebook in self.notebooks],
+            key=PlainTextNoteBook._recency_key))
+
+    def __getitem__(self, index):
+        return self._snapshot()[index]
+
+    def __iter__(self):
+        return iter(self._snapshot())
 
     def __reversed__(self):
-        return self._notes.__reversed__()
+        return reversed(self._snapshot())
 
     def __contains__(self, note):
-        return (note in self._notes)
+        return any(note in notebook for notebook in self.notebooks)
 
-class FileEventHandler(FileSystemEventHandler):
-    def __init__(self, notebook):
+
+def make_notebook(paths, *args, **kwargs):
+    """Return a notebook for one or more notes directories.
+
+    `paths` is a path or a list of them. A single directory gets a
+    PlainTextNoteBook and several get a MultiRootNoteBook, the other
+    arguments are passed on to either.
+
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    if len(paths) == 1:
+        return PlainTextNoteBook(paths[0], *args, **kwargs)
+    return MultiRootNoteBook(paths, *args, **kwargs)
+
+
+class FileEventHandler(object):
+    """Queues file system events and applies them to a notebook in batches.
+
+    Only the paths touched by created, deleted, modified and moved events
+    are queued. `delay` seconds after the first event of a burst the queued
+    paths are handed to PlainTextNoteBook.apply_changes() in one batch on
+    a timer thread.
+
+    This is a watchdog event handler, but doesn't subclass watchdog's
+    FileSystemEventHandler so that watchdog needn't be imported until the
+    notebook starts watching.
+
+    """
+
+    def __init__(self, notebook, delay=0.1):
         self._notebook = notebook
-    def on_created(self, e):
-        if not e.is_directory:
-            logger.debug("Detected new file {}".format(e.src_path))
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._paths = {}
+        self._timer = None
+
+    def _queue(self, path, is_directory):
+        with self._lock:
+            self._paths[path] = self._paths.get(path, False) or is_directory
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Apply the queued changes to the notebook now."""
+        with self._lock:
+            paths, self._paths = self._paths, {}
+            self._timer = None
+        if paths:
+            logger.debug("Applying changes to {} paths".format(len(paths)))
             try:
-                self._notebook.add_new(e.src_path)
-            except NoteAlreadyExistsError:
-                return super().on_created(e)
-        return super().on_created(e)
+                self._notebook.apply_changes(paths)
+            except Exception as e:
+                logger.exception(e)
+
+    def cancel(self):
+        """Drop the queued changes without applying them."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._paths = {}
+            self._timer = None
+
+    def dispatch(self, e):
+        """Pass a watchdog event to the on_*() method for its type."""
+        method = getattr(self, 'on_' + e.event_type, None)
+        if method is not None:
+            method(e)
+
+    def on_created(self, e):
+        logger.debug("Detected new file {}".format(e.src_path))
+        self._queue(e.src_path, e.is_directory)
+
     def on_deleted(self, e):
+        logger.debug("Detected deleted file {}".format(e.src_path))
+        self._queue(e.src_path, e.is_directory)
+
+    def on_modified(self, e):
         if not e.is_directory:
-            logger.debug("Detected deleted file {}".format(e.src_path))
-            self._notebook.remove(e.src_path)
-        return super().on_deleted(e)
+            logger.debug("Detected modified file {}".format(e.src_path))
+            self._queue(e.src_path, False)
+
+    def on_moved(self, e):
+        logger.debug("Detected moved file {} to {}".format(
+            e.src_path, e.dest_path))
+        self._queue(e.src_path, e.is_directory)
+        self._queue(e.dest_path, e.is_directory)
@@ -0,0 +1,290 @@
+"""A small query language for searching notes.
+
+A query is a list of terms separated by whitespace, and a note must match
+all of them:
+
+    word        the word is in the note's title or contents
+    "a phrase"  the phrase is in the note's title or contents
+    title:word  the word (or "phrase") is in the note's title
+    re:pattern  the regular expression matches the title or contents
+    -term       the term doesn't match
+    a OR b      either term matches
+
+Words, phrases and patterns that are all lowercase match case-insensitively,
+others match exactly. A query is compiled into a Query once, with its
+clauses in the order that's cheapest to check: title-only terms first, then
+words and phrases, then regular expressions.
+
+Case-insensitive words are matched by their search keys against the search
+keys of notes' titles and contents, see search_key(). Notes compute their
+keys once, when they're loaded or read, so matching a query doesn't
+transform any text.
+
+"""
+
+import bisect
+import functools
+import re
+import unicodedata
+
+# The kinds of term.
+WORD = 'word'
+TITLE = 'title'
+REGEX = 'regex'
+
+# The relative costs of checking each kind of term against a note.
+COSTS = {TITLE: 0, WORD: 1, REGEX: 2}
+
+TOKEN = re.compile(r'(-?)(?:(title|re):)?(?:"([^"]*)"?|(\S+))?')
+
+# Combining marks, which are removed from decomposed text to ignore accents.
+COMBINING_MARKS = re.compile(
+    '[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]+')
+
+NON_ASCII = re.compile('[^\x00-\x7f]')
+
+# Whether search keys ignore accents, see set_ignore_accents().
+ignore_accents = False
+
+
+def set_ignore_accents(enabled):
+    """Make case-insensitive words match regardless of accents, or not.
+
+    Must be called before any notes are loaded, since notes keep the
+    search keys they were given.
+
+    """
+    global ignore_accents
+    ignore_accents = bool(enabled)
+    word_key.cache_clear()
+    ascii_folding_bytes.cache_clear()
+    compile_query.cache_clear()
+
+
+def search_key(text):
+    """Return the form of `text` that case-insensitive words are matched in.
+
+    The text is normalized to NFC and casefolded, so that for example
+    "STRASSE" matches "Straße" and composed and decomposed accents match
+    each other. If ignore_accents is set, accents are removed as well.
+
+    """
+    text = unicodedata.normalize('NFC', text).casefold()
+    if ignore_accents:
+        text = COMBINING_MARKS.sub('', unicodedata.normalize('NFD', text))
+        text = unicodedata.normalize('NFC', text)
+    return text
+
+
+@functools.lru_cache(maxsize=256)
+def word_key(word):
+    """Return what a search word is looked for as in notes.
+
+    Lowercase words, which match case-insensitively, become their
+    search_key(), others are only normalized to NFC.
+
+    """
+    if word.islower():
+        return search_key(word)
+    return unicodedata.normalize('NFC', word)
+
+
+@functools.lru_cache(maxsize=1)
+def ascii_folding_bytes():
+    """Return a bytes regex for the non-ASCII characters that fold to ASCII.
+
+    Matches the UTF-8 encodings of the characters whose search_key() has
+    ASCII letters in it, like "ß" and the Kelvin sign. Text without any
+    of them has the same search key as its ASCII lowercasing.
+
+    """
+    characters = []
+    for code_point in range(0x80, 0x10000):
+        character = chr(code_point)
+        if 0xd800 <= code_point < 0xe000:
+            continue
+        if any(ord(folded) < 0x80 for folded in search_key(character)):
+            characters.append(re.escape(character.encode('utf-8')))
+    return re.compile(b'|'.join(characters))
+
+
+def key_offsets(text, key):
+    """Return a function mapping offsets in `key` to offsets in `text`.
+
+    `key` must be search_key(text). A key can be longer or shorter than
+    its text, "ß" becomes "ss" for example, so offsets found in the key
+    are mapped back to the text with the returned function. Returns None
+    if the offsets are the same in both, or if they can't be lined up.
+
+    """
+    if len(key) == len(text):
+        return None
+    # The text offset of each run of key offsets that follow on from it.
+    key_starts = [0]
+    text_starts = [0]
+    shift = 0
+    for match in NON_ASCII.finditer(text):
+        length = len(search_key(match.group()))
+        if length == 1:
+            continue
+        offset = match.start()
+        for extra in range(length):
+            key_starts.append(offset + shift + extra)
+            text_starts.append(offset)
+        key_starts.append(offset + shift + length)
+        text_starts.append(offset + 1)
+        shift += length - 1
+    if shift != len(key) - len(text):
+        return None
+
+    def to_text(offset):
+        run = bisect.bisect_right(key_starts, offset) - 1
+        return text_starts[run] + offset - key_starts[run]
+    return to_text
+
+
+class Term(object):
+    """A word, phrase or pattern that a note must (or mustn't) match.
+
+    Words and phrases are looked for as their word_key().
+
+    """
+
+    __slots__ = ('kind', 'text', 'negated', 'lower', 'key', 'pattern')
+
+    def __init__(self, kind, text, negated=False):
+        self.kind = kind
+        self.text = text
+        self.negated = negated
+        self.lower = text.islower()
+        self.key = word_key(text)
+        self.pattern = None
+        if kind == REGEX:
+            flags = 0 if any(c.isupper() for c in text) else re.IGNORECASE
+            try:
+                self.pattern = re.compile(text, flags)
+            except re.error:
+                # Match an unfinished pattern literally while it's typed.
+                self.pattern = re.compile(re.escape(text), flags)
+
+    @property
+    def cost(self):
+        return COSTS[self.kind]
+
+    def matches(self, note):
+        if self.kind == REGEX:
+            found = (self.pattern.search(note.title_nfc) is not None
+                     or self.pattern.search(note.contents) is not None)
+        else:
+            title = note.title_key if self.lower else note.title_nfc
+            found = self.key in title
+            if not found and self.kind == WORD:
+                found = note.contains(self.key)
+        return found != self.negated
+
+    def implies(self, other):
+        """Return True if every note matching this term matches `other`."""
+        if self.kind == REGEX or other.kind == REGEX:
+            return (self.kind == other.kind and self.text == other.text
+                    and self.negated == other.negated)
+        if self.negated != other.negated:
+            return False
+        if self.negated:
+            # Lacking a word means lacking every word that contains it.
+            return (self.kind == other.kind and self.lower == other.lower
+                    and self.key in other.key)
+        if self.kind != other.kind and other.kind != WORD:
+            return False
+        if other.lower:
+            # Text containing this word has a search key containing the
+            # word's search key.
+            return other.key in (self.key if self.lower
+                                 else search_key(self.text))
+        return not self.lower and other.key in self.key
+
+    def __eq__(self, other):
+        return (isinstance(other, Term) and self.kind == other.kind
+                and self.text == other.text and self.negated == other.negated)
+
+    def __hash__(self):
+        return hash((self.kind, self.text, self.negated))
+
+    def __repr__(self):
+        return 'Term({!r}, {!r}, negated={!r})'.format(
+            self.kind, self.text, self.negated)
+
+
+class Query(object):
+    """A compiled query: clauses of terms, any of which must match.
+
+    Every clause must match a note for the note to match the query.
+
+    """
+
+    def __init__(self, clauses):
+        # Cheapest first, clauses of equal cost keep their order.
+        self.clauses = sorted(
+            (sorted(clause, key=lambda term: term.cost) for clause in clauses),
+            key=lambda clause: max(term.cost for term in clause))
+
+    def matches(self, note):
+        for clause in self.clauses:
+            for term in clause:
+                if term.matches(note):
+                    break
+            else:
+                return False
+        return True
+
+    @property
+    def words(self):
+        """The words and phrases that matching notes contain, in order."""
+        return [term.text for clause in self.clauses for term in clause
+                if term.kind != REGEX and not term.negated]
+
+    def literal_clauses(self):
+        """Return the texts of the clauses made only of words and phrases.
+
+        A note matching the query contains one of the texts of each clause,
+        in its title or contents, so these can be looked up in an index.
+
+        """
+        return [[term.text for term in clause] for clause in self.clauses
+                if all(term.kind != REGEX and not term.negated
+                       for term in clause)]
+
+    def implies(self, other):
+        """Return True if every note matching this query matches `other`."""
+        return all(
+            any(all(any(term.implies(other_term) for other_term in other_clause)
+                    for term in clause)
+                for clause in self.clauses)
+            for other_clause in other.clauses)
+
+
+@functools.lru_cache(maxsize=128)
+def compile_query(query):
+    """Return the Query for a query string."""
+    clauses = []
+    either = False
+    for match in TOKEN.finditer(query):
+        negated, prefix, phrase, word = match.groups()
+        text = phrase if phrase is not None else word
+        if not text:
+            continue
+        if word == 'OR' and not negated and not prefix:
+            either = bool(clauses)
+            continue
+        kind = {None: WORD, 'title': TITLE, 're': REGEX}[prefix]
+        term = Term(kind, text, negated=bool(negated))
+        if either:
+            clauses[-1].append(term)
+        else:
+            clauses.append([term])
+        either = False
+    return Query(clauses)
+
+
+def search_words(query):
+    """Return the words and phrases that notes matching `query` contain."""
+    return compile_query(query).words
@@ -0,0 +1,256 @@
+"""Sharded search of notes across a pool of worker processes."""
+
+import logging
+logger = logging.getLogger("tv3")
+
+import multiprocessing
+import os
+import threading
+import unicodedata
+
+import tv_notebook
+import tv_query
+
+# Workers are started after the UI, search and watchdog threads are, and
+# forking a process with threads running isn't safe, so they're started
+# from a fork server (or spawned where there isn't one).
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    CONTEXT = multiprocessing.get_context('forkserver')
+else:
+    CONTEXT = multiprocessing.get_context('spawn')
+
+
+class ShardNote(object):
+    """A note as held by a worker, with its contents read in advance.
+
+    Has the parts of the PlainTextNote interface that queries use. The
+    contents of large notes aren't kept, they're scanned on disk.
+
+    """
+
+    __slots__ = ('abspath', 'title', 'title_nfc', 'title_key', '_contents',
+                 '_contents_key')
+
+    def __init__(self, abspath, title, max_note_size):
+        self.abspath = abspath
+        self.title = title
+        self.title_nfc = unicodedata.normalize('NFC', title)
+        self.title_key = tv_query.search_key(title)
+        try:
+            with open(abspath, 'rb') as fp:
+                if os.fstat(fp.fileno()).st_size > max_note_size:
+                    contents = None
+                else:
+                    contents = tv_notebook.decode_note(fp.read())
+        except (IOError, OSError):
+            contents = ''
+        self._contents = contents
+        self._contents_key = (None if contents is None
+                              else tv_query.search_key(contents))
+
+    @property
+    def contents(self):
+        if self._contents is not None:
+            return self._contents
+        try:
+            with open(self.abspath, 'rb') as fp:
+                return tv_notebook.decode_note(fp.read())
+        except (IOError, OSError):
+            return ''
+
+    def contains(self, search_word):
+        if self._contents is None:
+            try:
+                return tv_notebook.scan_file(self.abspath, search_word)
+            except (IOError, OSError):
+                return False
+        if search_word.islower():
+            return search_word in self._contents_key
+        return search_word in self._contents
+
+
+class Shard(object):
+    """The notes held by one worker process, and their contents.
+
+    Matches notes with the same semantics as brute_force_search. Contents
+    are read when notes are added or updated, except for notes bigger than
+    `max_note_size`, which are scanned on disk by scan_file(). A query
+    that refines the previous one only searches the previous matches.
+
+    """
+
+    def __init__(self, max_note_size):
+        self.max_note_size = max_note_size
+        # ShardNotes by abspath.
+        self._notes = {}
+        self._last_search = None
+
+    def update(self, entries):
+        """Add or reread the notes in a list of (abspath, title) pairs."""
+        for abspath, title in entries:
+            self._notes[abspath] = ShardNote(
+                abspath, title, self.max_note_size)
+        self._last_search = None
+
+    def remove(self, abspaths):
+        for abspath in abspaths:
+            self._notes.pop(abspath, None)
+        self._last_search = None
+
+    def search(self, query):
+        """Return the abspaths of the notes that match `query`."""
+        last_search = self._last_search
+        if (last_search is not None
+                and tv_notebook.is_refinement(last_search[0], query)):
+            notes = last_search[1]
+        else:
+            notes = self._notes.values()
+        matches = list(tv_notebook.iter_brute_force_search(notes, query))
+        self._last_search = (query, matches)
+        return [note.abspath for note in matches]
+
+
+def serve(connection, max_note_size, ignore_accents=False):
+    """Run a Shard in a worker process, taking commands from `connection`.
+
+    Commands are tuples of a Shard method name and its arguments. The
+    results of searches are sent back, and None stops the worker. Search
+    keys are made as in the parent process, see
+    tv_query.set_ignore_accents().
+
+    """
+    tv_query.set_ignore_accents(ignore_accents)
+    shard = Shard(max_note_size)
+    while True:
+        try:
+            command = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if command is None:
+            break
+        if command[0] == 'search':
+            connection.send(shard.search(*command[1:]))
+        else:
+            getattr(shard, command[0])(*command[1:])
+    connection.close()
+
+
+class ShardedSearch(object):
+    """A PlainTextNoteBook search function that searches in parallel.
+
+    Has the same semantics as brute_force_search. When attached to a
+    notebook its notes are partitioned across `workers` resident worker
+    processes (by default one per CPU), each of which reads and keeps the
+    contents of its own shard. Queries are sent to all of the workers at
+    once and their matches merged, so searching isn't bound to one core.
+    Changes to notes are sent to the worker holding them.
+
+    The workers refine their own previous matches, so the notebook always
+    calls this with the whole notebook. Called with any other iterable of
+    notes, or if a worker has died, it falls back to brute_force_search.
+
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self._notebook = None
+        self._notes = {}
+        self._connections = []
+        self._processes = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_refinement(old_query, new_query):
+        return False
+
+    def _shard(self, abspath):
+        return hash(abspath) % len(self._connections)
+
+    def attach(self, notebook):
+        """Start the workers and send them the notes in `notebook`."""
+        for _ in range(self.workers):
+            parent, child = CONTEXT.Pipe()
+            process = CONTEXT.Process(
+                target=serve, args=(child, notebook.max_note_size,
+                                    tv_query.ignore_accents),
+                daemon=True)
+            process.start()
+            child.close()
+            self._connections.append(parent)
+            self._processes.append(process)
+        shards = [[] for _ in self._connections]
+        for note in notebook:
+            self._notes[note.abspath] = note
+            shards[self._shard(note.abspath)].append(
+                (note.abspath, note.title))
+        with self._lock:
+            for connection, entries in zip(self._connections, shards):
+                connection.send(('update', entries))
+        self._notebook = notebook
+        notebook.add_listener(self)
+        logger.debug('Sharded {} notes across {} workers'.format(
+            len(self._notes), self.workers))
+
+    def _send(self, abspath, command):
+        with self._lock:
+            if not self._connections:
+                return
+            try:
+                self._connections[self._shard(abspath)].send(command)
+            except (OSError, ValueError) as e:
+                logger.error('Could not update search worker: {}'.format(e))
+
+    def note_added(self, note):
+        self._notes[note.abspath] = note
+        self._send(note.abspath, ('update', [(note.abspath, note.title)]))
+
+    def note_changed(self, note):
+        self.note_added(note)
+
+    def note_removed(self, note):
+        self._notes.pop(note.abspath, None)
+        self._send(note.abspath, ('remove', [note.abspath]))
+
+    def _search(self, query):
+        """Return the matching notes from all of the workers, or None."""
+        with self._lock:
+            if not self._connections:
+                return None
+            try:
+                for connection in self._connections:
+                    connection.send(('search', query))
+                abspaths = []
+                for connection in self._connections:
+                    abspaths.extend(connection.recv())
+            except (EOFError, OSError, ValueError) as e:
+                logger.error('Search worker failed: {}'.format(e))
+                self._close()
+                return None
+        notes = self._notes
+        return [notes[abspath] for abspath in abspaths if abspath in notes]
+
+    def __call__(self, notebook, query):
+        if notebook is self._notebook:
+            matching_notes = self._search(query)
+            if matching_notes is not None:
+                return notebook.by_recency(matching_notes)
+        return tv_notebook.brute_force_search(notebook, query)
+
+    def close(self):
+        """Stop the worker processes."""
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        for connection in self._connections:
+            try:
+                connection.send(None)
+                connection.close()
+            except (OSError, ValueError):
+                pass
+        for process in self._processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        self._connections = []
+        self._processes = []
@@ -0,0 +1,155 @@
+"""Timing and profiling of Terminal Velocity's hot paths."""
+
+import logging
+logger = logging.getLogger("tv3")
+
+import collections
+import contextlib
+import cProfile
+import io
+import pstats
+import threading
+import time
+
+
+class Histogram(object):
+    """Latencies recorded for one timer, bucketed by powers of two ms."""
+
+    # The upper bounds of the buckets in milliseconds, the last bucket has
+    # no upper bound.
+    BOUNDS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+    def __init__(self, samples=10000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self._samples = collections.deque(maxlen=samples)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.last = seconds
+        self._samples.append(seconds)
+        milliseconds = seconds * 1000
+        for i, bound in enumerate(self.BOUNDS):
+            if milliseconds < bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def percentile(self, fraction):
+        """Return the given percentile, in seconds, of recent samples."""
+        if not self._samples:
+            return 0.0
+        samples = sorted(self._samples)
+        return samples[int(fraction * (len(samples) - 1))]
+
+    def __str__(self):
+        labels = []
+        lower = 0
+        for bound, count in zip(self.BOUNDS + (None,), self.buckets):
+            if count:
+                if bound is None:
+                    labels.append('>={}ms:{}'.format(lower, count))
+                else:
+                    labels.append('<{}ms:{}'.format(bound, count))
+            lower = bound
+        return ' '.join(labels)
+
+
+class Stats(object):
+    """Named timers for the hot paths, and optional cProfile profiling.
+
+    Timers are cheap enough to be always on. Profiling has to be enabled
+    with enable_profiling() and covers every call made through profile(),
+    whichever thread it's made on.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers = collections.OrderedDict()
+        self.profiling = False
+        self._profiles = []
+
+    def record(self, name, seconds):
+        """Add a latency, in seconds, to the named timer."""
+        with self._lock:
+            histogram = self.timers.get(name)
+            if histogram is None:
+                histogram = self.timers[name] = Histogram()
+            histogram.add(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Time the body of a with statement with the named timer."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def last(self, name):
+        """Return the last latency recorded by the named timer, in ms."""
+        histogram = self.timers.get(name)
+        return histogram.last * 1000 if histogram else 0.0
+
+    def enable_profiling(self):
+        self.profiling = True
+
+    def profile(self, function, *args, **kwargs):
+        """Call function, under cProfile if profiling is enabled."""
+        if not self.profiling:
+            return function(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active on this interpreter.
+            return function(*args, **kwargs)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._lock:
+                self._profiles.append(profile)
+
+    def dump_profile(self, path):
+        """Write the merged profiles to `path` and return a text report."""
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return ''
+        report = io.StringIO()
+        merged = pstats.Stats(profiles[0], stream=report)
+        for profile in profiles[1:]:
+            merged.add(profile)
+        merged.dump_stats(path)
+        merged.sort_stats('cumulative').print_stats(30)
+        return report.getvalue()
+
+    def summary(self):
+        """Return a table of all of the timers."""
+        lines = ['{:<12} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9}  {}'.format(
+            'timer', 'count', 'total ms', 'mean ms', 'p50 ms', 'p90 ms',
+            'max ms', 'histogram')]
+        with self._lock:
+            timers = list(self.timers.items())
+        for name, histogram in timers:
+            lines.append(
+                '{:<12} {:>7} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'
+                '  {}'.format(
+                    name, histogram.count, histogram.total * 1000,
+                    histogram.total * 1000 / histogram.count,
+                    histogram.percentile(0.5) * 1000,
+                    histogram.percentile(0.9) * 1000,
+                    histogram.max * 1000, histogram))
+        return '\n'.join(lines)
+
+
+# The timers shared by the whole application.
+stats = Stats()
@@ -3,20 +3,39 @@
 import logging
 logger = logging.getLogger("tv3")
 
+import tv_index
 import tv_notebook
+import tv_query
+import tv_stats
+import collections
+import concurrent.futures
+import os
 import pipes
 import shlex
 import subprocess
+import threading
+import time
 import urwid
 
 palette = [
     ('autocomplete', 'black', 'brown'),
     ('notewidget focused', 'black', 'brown'),
     ('notewidget unfocused', 'default', 'default'),
+    ('snippet', 'dark gray', 'default'),
+    ('snippet focused', 'dark gray', 'brown'),
+    ('match', 'yellow', 'default'),
+    ('match focused', 'white', 'brown'),
     ('placeholder', 'dark blue', 'default'),
+    ('root', 'dark cyan', 'default'),
+    ('root focused', 'dark blue', 'brown'),
     ('search', 'default', 'default'),
+    ('stats', 'dark gray', 'default'),
 ]
 
+# How many notes to load between updates of the screen when loading notes
+# in the background.
+LOAD_BATCH_SIZE = 2000
+
 
 def system(cmd, loop):
     """Execute a system command in a subshell and return the exit status."""
@@ -41,9 +60,65 @@ def placeholder_text(text):
 
 
 class NoteWidget(urwid.Text):
+    """A note's title, followed by a snippet of its matches for a query.
+
+    The snippet is only worked out when the widget is shown, and is kept
+    until the note or the query changes. Notes from a notebook with several
+    notes directories have the name of theirs before the title.
+
+    """
+
     def __init__(self, note):
         self.note = note
-        return super(NoteWidget, self).__init__(note.title)
+        self._query = ''
+        self._match_offsets = tv_notebook.match_offsets
+        self._snippet_key = None
+        return super(NoteWidget, self).__init__(self._title_markup())
+
+    def _title_markup(self):
+        name = getattr(self.note.notebook, 'name', None)
+        if name:
+            return [('root', '[{}] '.format(name)), (None, self.note.title)]
+        return [(None, self.note.title)]
+
+    def set_query(self, query, match_offsets=tv_notebook.match_offsets):
+        """Show a snippet of the matches for `query`.
+
+        `match_offsets(note, search_words)` finds the matches in the note's
+        contents.
+
+        """
+        self._query = query
+        self._match_offsets = match_offsets
+
+    def _update_snippet(self):
+        key = (self.note.signature, self._query)
+        if key == self._snippet_key:
+            return
+        self._snippet_key = key
+        try:
+            text, highlights = tv_notebook.snippet(
+                self.note, tv_query.search_words(self._query),
+                self._match_offsets)
+        except (IOError, OSError) as e:
+            logger.debug('No snippet for {}: {}'.format(self.note.abspath, e))
+            text = ''
+        if not text:
+            self.set_text(self._title_markup())
+            self.set_wrap_mode('space')
+            return
+        markup = self._title_markup() + [('snippet', '  ')]
+        position = 0
+        for start, end in highlights:
+            start = max(start, position)
+            if start >= end:
+                continue
+            markup.append(('snippet', text[position:start]))
+            markup.append(('match', text[start:end]))
+            position = end
+        markup.append(('snippet', text[position:]))
+        self.set_text([part for part in markup if part[1]])
+        self.set_wrap_mode('clip')
 
     def selectable(self):
         return True
@@ -51,10 +126,18 @@ class NoteWidget(urwid.Text):
     def keypress(self, size, key):
         return key
 
+    def rows(self, size, focus=False):
+        self._update_snippet()
+        return super(NoteWidget, self).rows(size, focus=focus)
+
     def render(self, size, focus=False):
         """Render the widget applying focused and unfocused display attrs."""
+        self._update_snippet()
         if focus:
-            attr_map = {None: 'notewidget focused'}
+            attr_map = {None: 'notewidget focused',
+                        'root': 'root focused',
+                        'snippet': 'snippet focused',
+                        'match': 'match focused'}
         else:
             attr_map = {None: 'notewidget unfocused'}
         canv = super(NoteWidget, self).render(size, focus=focus)
@@ -116,18 +199,110 @@ class AutocompleteWidget(urwid.Edit):
         return False
 
 
+class NoteListWalker(urwid.ListWalker):
+    """A list walker over a sequence of notes that makes widgets lazily.
+
+    A NoteWidget is only made when urwid asks for a position, which it does
+    for the rows on screen and their neighbours. Widgets are kept for reuse
+    in a pool of at most `pool_size` widgets, least recently used first out.
+
+    """
+
+    def __init__(self, notes=(), pool_size=256):
+        self._notes = notes
+        self._query = ''
+        self._match_offsets = tv_notebook.match_offsets
+        self.focus = 0
+        self.pool_size = pool_size
+        self._widgets = collections.OrderedDict()
+        self._positions = {}
+        self._positions_end = 0
+
+    def set_notes(self, notes, query='',
+                  match_offsets=tv_notebook.match_offsets):
+        """Show the sequence `notes` instead, focusing the first one.
+
+        The notes' widgets show snippets of their matches for `query`, see
+        NoteWidget.set_query().
+
+        """
+        self._notes = notes
+        self._query = query
+        self._match_offsets = match_offsets
+        self.focus = 0
+        self._positions = {}
+        self._positions_end = 0
+        self._modified()
+
+    def _widget(self, note):
+        widget = self._widgets.get(note.abspath)
+        if widget is None or widget.note is not note:
+            widget = NoteWidget(note)
+            self._widgets[note.abspath] = widget
+            while len(self._widgets) > self.pool_size:
+                self._widgets.popitem(last=False)
+        else:
+            self._widgets.move_to_end(note.abspath)
+        widget.set_query(self._query, self._match_offsets)
+        return widget
+
+    def __len__(self):
+        return len(self._notes)
+
+    def __getitem__(self, position):
+        if position < 0:
+            raise IndexError(position)
+        return self._widget(self._notes[position])
+
+    def next_position(self, position):
+        if position + 1 >= len(self._notes):
+            raise IndexError(position)
+        return position + 1
+
+    def prev_position(self, position):
+        if position <= 0:
+            raise IndexError(position)
+        return position - 1
+
+    def positions(self, reverse=False):
+        if reverse:
+            return range(len(self._notes) - 1, -1, -1)
+        return range(len(self._notes))
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def position_of(self, note):
+        """Return the position of `note`, or None if it isn't listed.
+
+        Positions are recorded as the notes are searched, so finding a note
+        near the top doesn't look at the rest.
+
+        """
+        position = self._positions.get(note.abspath)
+        while position is None and self._positions_end < len(self._notes):
+            listed = self._notes[self._positions_end]
+            self._positions[listed.abspath] = self._positions_end
+            if listed.abspath == note.abspath:
+                position = self._positions_end
+            self._positions_end += 1
+        return position
+
+
 class NoteFilterListBox(urwid.ListBox):
     """A filterable list of notes from a notebook."""
 
     def __init__(self, on_changed=None):
         """Initialise a new NoteFilterListBox."""
         self._fake_focus = False
-        self.list_walker = urwid.SimpleFocusListWalker([])
-        self.widgets = {}
+        self.list_walker = NoteListWalker()
         super(NoteFilterListBox, self).__init__(self.list_walker)
         self.on_changed = on_changed
 
     def get_selected_note(self):
+        if self.focus is None:
+            return None
         return self.focus.note
 
     selected_note = property(get_selected_note)
@@ -148,27 +323,16 @@ class NoteFilterListBox(urwid.ListBox):
             return placeholder.render(size)
         return super(NoteFilterListBox, self).render(size, self.fake_focus)
 
-    def filter(self, matching_notes):
+    def filter(self, matching_notes, query='',
+               match_offsets=tv_notebook.match_offsets):
         """Filter this listbox to show only widgets for matching notes."""
-        matching_widgets = []
-        for note in matching_notes:
-            widget = self.widgets.get(note.abspath)
-            if widget:
-                matching_widgets.append(widget)
-            else:
-                widget = NoteWidget(note)
-                self.widgets[note.abspath] = widget
-                matching_widgets.append(widget)
-        del self.list_walker[:]
-        for widget in matching_widgets:
-            self.list_walker.append(widget)
+        self.list_walker.set_notes(matching_notes, query, match_offsets)
 
     def focus_note(self, note):
         """Focus the widget for the given note."""
-        for widget in self.list_walker:
-            if widget.note == note:
-                self.list_walker.set_focus(self.list_walker.index(widget))
-                break
+        position = self.list_walker.position_of(note)
+        if position is not None:
+            self.list_walker.set_focus(position)
 
     def keypress(self, size, key):
         result = super(NoteFilterListBox, self).keypress(size, key)
@@ -192,14 +356,65 @@ class MainFrame(urwid.Frame):
             extension,
             extensions,
             exclude=None,
+            cache_bytes=tv_notebook.DEFAULT_CACHE_BYTES,
+            max_note_size=tv_notebook.DEFAULT_MAX_NOTE_SIZE,
+            search_engine='brute',
+            search_workers=None,
+            index_cache=None,
+            search_delay=0.0,
+            show_stats=False,
+            sort='mtime',
+            match_mode='exact',
+            load_in_background=False,
     ):
+        """Make the frame and its notebook.
+
+        `notes_dir` is a notes directory, or a list of them to search
+        together, see tv_notebook.make_notebook().
+
+        If `load_in_background` is True the notes are loaded on a background
+        thread once the main loop is set, and the frame shows the notes
+        loaded so far in the meantime.
+
+        """
         self.editor = editor
-        self.tv_notebook = tv_notebook.PlainTextNoteBook(
+        # How to order matching notes: 'mtime' or 'relevance'.
+        self.sort = sort
+        # Seconds to wait after a keystroke before searching.
+        self.search_delay = search_delay
+        self._loop = None
+        self._wake_pipe = None
+        self._search_executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._search_lock = threading.Lock()
+        self._search_serial = 0
+        self._search_future = None
+        self._search_alarm = None
+        self._search_result = None
+        self._notes_changed = False
+        # When the oldest keystroke not yet shown on screen was pressed, and
+        # whether the screen is waiting for search results.
+        self._keystroke_time = None
+        self._awaiting_results = False
+        self.stats_line = None
+        if show_stats:
+            self.stats_line = urwid.Text(('stats', ''), wrap='clip')
+        self.tv_notebook = tv_notebook.make_notebook(
             notes_dir,
             extension,
             extensions,
+            search_function=tv_index.make_search_function(
+                search_engine, cache_dir=index_cache, match_mode=match_mode,
+                workers=search_workers),
             exclude=exclude,
+            cache_bytes=cache_bytes,
+            max_note_size=max_note_size,
+            load=False,
         )
+        self.tv_notebook.add_listener(self)
+        self._load_in_background = load_in_background
+        self.loading_line = urwid.Text(('stats', ''), wrap='clip')
+        if not load_in_background:
+            self.tv_notebook.load()
         self.suppress_filter = False
         self.suppress_focus = False
         self._selected_note = None
@@ -213,10 +428,29 @@ class MainFrame(urwid.Frame):
         super(MainFrame, self).__init__(
             header=urwid.LineBox(self.search_box),
             body=None,
+            footer=self.stats_line,
             focus_part='body',
         )
+        self.update_loading_line()
         self.filter(self.search_box.edit_text)
 
+    def get_loop(self):
+        return self._loop
+
+    def set_loop(self, loop):
+        """Set the main loop, other threads wake it through a pipe.
+
+        Starts loading the notes if they're to be loaded in the background.
+
+        """
+        self._loop = loop
+        self._wake_pipe = loop.watch_pipe(self._on_wake)
+        if self._load_in_background and not self.tv_notebook.loaded.is_set():
+            thread = threading.Thread(target=self._load_notes, daemon=True)
+            thread.start()
+
+    loop = property(get_loop, set_loop)
+
     def get_selected_note(self):
         return self._selected_note
 
@@ -225,7 +459,8 @@ class MainFrame(urwid.Frame):
         if self.suppress_focus:
             return
         if note:
-            self.search_box.autocomplete_text = note.title
+            # NFC, like typed text, so that it lines up with the query.
+            self.search_box.autocomplete_text = note.title_nfc
             self.list_box.fake_focus = True
             self.list_box.focus_note(note)
         else:
@@ -237,9 +472,61 @@ class MainFrame(urwid.Frame):
 
     def quit(self):
         """Quit the app."""
+        if self._search_future is not None:
+            self._search_future.cancel()
+        self._search_executor.shutdown(wait=False)
+        close = getattr(self.tv_notebook.search_function, 'close', None)
+        if close is not None:
+            close()
         raise urwid.ExitMainLoop()
 
+    def render(self, size, focus=False):
+        """Render the frame, timing it and the keystroke it shows.
+
+        The keystroke is timed up to the render, so that the stats line is
+        updated before the canvas showing it is built.
+
+        """
+        if self._keystroke_time is not None and not self._awaiting_results:
+            tv_stats.stats.record(
+                'keystroke', time.perf_counter() - self._keystroke_time)
+            self._keystroke_time = None
+            self.update_stats_line()
+        with tv_stats.stats.timer('render'):
+            return super(MainFrame, self).render(size, focus=focus)
+
+    def _load_notes(self):
+        try:
+            self.tv_notebook.load(batch_size=LOAD_BATCH_SIZE)
+        except Exception as e:
+            logger.exception(e)
+
+    def update_loading_line(self):
+        """Show how many notes have been loaded until they all have been."""
+        if self.tv_notebook.loaded.is_set():
+            self.footer = self.stats_line
+            return
+        self.loading_line.set_text(('stats', 'Loading {} notes\u2026'.format(
+            len(self.tv_notebook))))
+        self.footer = self.loading_line
+
+    def update_stats_line(self):
+        """Show the latest timings in the stats line, if there is one."""
+        if self.stats_line is None:
+            return
+        stats = tv_stats.stats
+        self.stats_line.set_text(('stats', (
+            'key {:.1f}ms  search {:.1f}ms  list {:.1f}ms  render {:.1f}ms  '
+            '{} matches  cache {}/{}').format(
+                stats.last('keystroke'), stats.last('search'),
+                stats.last('list'), stats.last('render'),
+                len(self.list_box.list_walker),
+                self.tv_notebook.content_cache.hits,
+                self.tv_notebook.content_cache.misses)))
+
     def keypress(self, size, key):
+        if self._keystroke_time is None:
+            self._keystroke_time = time.perf_counter()
         maxcol, maxrow = size
         self.suppress_filter = False
         self.suppress_focus = False
@@ -295,7 +582,7 @@ class MainFrame(urwid.Frame):
                 if self.search_box.edit_text == '':
                     consume = True
                 else:
-                    title = self.selected_note.title.lower()
+                    title = self.selected_note.title_nfc.lower()
                     typed = self.search_box.edit_text.lower()
                     if not title.startswith(typed):
                         consume = True
@@ -309,28 +596,141 @@ class MainFrame(urwid.Frame):
             return self.search_box.keypress((maxcol, ), key)
         return None # can't reach this line, but suppresses linter error
 
-    def filter(self, query):
-        """Do the synchronised list box filter and search box autocomplete."""
+    def filter(self, query, keep_note=None):
+        """Do the synchronised list box filter and search box autocomplete.
+
+        Once the main loop is running the search is done in a background
+        thread, `search_delay` seconds after the last call, and its results
+        are applied from the main loop. Results for a query that has since
+        been replaced by a newer one are discarded.
+
+        If `keep_note` is among the results it stays selected.
+
+        """
         if self.suppress_filter:
             return
-        if len(self.tv_notebook) == 0:
+        if self.loop is None:
+            self.apply_filter(query, self.search(query), keep_note)
+            return
+        with self._search_lock:
+            self._search_serial += 1
+            serial = self._search_serial
+        if self._search_future is not None:
+            self._search_future.cancel()
+        if self._search_alarm is not None:
+            self.loop.remove_alarm(self._search_alarm)
+            self._search_alarm = None
+        self._awaiting_results = True
+        args = (serial, query, self.suppress_focus, keep_note)
+        if self.search_delay > 0:
+            self._search_alarm = self.loop.set_alarm_in(
+                self.search_delay, self._on_search_alarm, args)
+        else:
+            self._submit_search(*args)
+
+    def _on_search_alarm(self, loop, args):
+        self._submit_search(*args)
+
+    def _submit_search(self, *args):
+        self._search_alarm = None
+        self._search_future = self._search_executor.submit(
+            self._background_search, *args)
+
+    def _background_search(self, serial, query, suppress_focus, keep_note):
+        """Search in the background and pass the results to the main loop."""
+        if serial != self._search_serial:
+            return
+        try:
+            matching_notes = tv_stats.stats.profile(self.search, query)
+        except Exception as e:
+            logger.exception(e)
+            return
+        with self._search_lock:
+            if serial != self._search_serial:
+                logger.debug('Discarding results for {!r}'.format(query))
+                return
+            self._search_result = (
+                query, matching_notes, suppress_focus, keep_note)
+        os.write(self._wake_pipe, b'.')
+
+    def notes_changed(self):
+        """Called by the notebook, from its event thread, after changes."""
+        with self._search_lock:
+            self._notes_changed = True
+        if self._wake_pipe is not None:
+            os.write(self._wake_pipe, b'.')
+
+    def _on_wake(self, data):
+        """Apply search results and notebook changes in the main loop."""
+        with self._search_lock:
+            result = self._search_result
+            self._search_result = None
+            notes_changed = self._notes_changed
+            self._notes_changed = False
+        if result is not None:
+            query, matching_notes, suppress_focus, keep_note = result
+            self.suppress_focus = suppress_focus
+            self.apply_filter(query, matching_notes, keep_note)
+        if notes_changed:
+            self.update_loading_line()
+            self.refresh()
+        return True
+
+    def refresh(self):
+        """Search again for the current text, keeping the selected note."""
+        self.filter(self.search_box.edit_text, keep_note=self.selected_note)
+
+    def search(self, query):
+        """Return the notes matching `query` in the configured order.
+
+        Notes are most recently modified first, or most relevant first if
+        sorting by relevance.
+
+        """
+        if self.sort != 'relevance' or not query.strip():
+            return self.tv_notebook.search(query)
+        # The ranking is cached like the matches it's made from, and is
+        # reused until a note changes.
+        result_cache = self.tv_notebook.result_cache
+        key = (query, 'relevance')
+        generation = self.tv_notebook.generation
+        ranked = result_cache.get(key, generation)
+        if ranked is None:
+            matching_notes = self.tv_notebook.search(query)
+            score = getattr(self.tv_notebook.search_function, 'relevance',
+                            tv_notebook.relevance)
+            with tv_stats.stats.timer('rank'):
+                ranked = tv_notebook.RankedResults(
+                    matching_notes, query, score=score)
+            result_cache.put(key, generation, ranked)
+        return ranked
+
+    def apply_filter(self, query, matching_notes, keep_note=None):
+        """Show `matching_notes` in the list box and autocomplete from them."""
+        self._awaiting_results = False
+        if len(self.tv_notebook) == 0 and not self.tv_notebook.loaded.is_set():
+            self.body = placeholder_text('Loading notes\u2026')
+        elif len(self.tv_notebook) == 0:
             self.body = placeholder_text(
                 'You have no notes yet, to create '
                 'a note type a note title then press Enter')
         else:
             self.body = urwid.Padding(self.list_box, left=1, right=1)
-        matching_notes = self.tv_notebook.search(query)
-        matching_notes.sort(key=lambda x: x.mtime, reverse=True)
-        self.list_box.filter(matching_notes)
-        autocompletable_matches = []
+        match_offsets = getattr(self.tv_notebook.search_function,
+                                'match_offsets', tv_notebook.match_offsets)
+        with tv_stats.stats.timer('list'):
+            self.list_box.filter(matching_notes, query, match_offsets)
+        autocompletable_match = None
         if query:
-            for note in matching_notes:
-                if note.title.lower().startswith(query.lower()):
-                    autocompletable_matches.append(note)
-        if autocompletable_matches:
-            self.selected_note = autocompletable_matches[0]
+            # The newest note whose title starts with the query and that
+            # matches it (a title:, re:, negated or capitalized term
+            # mightn't).
+            autocompletable_match = self.tv_notebook.complete_title(
+                query, tv_query.compile_query(query).matches)
+        if keep_note is not None and keep_note in matching_notes:
+            self.selected_note = keep_note
         else:
-            self.selected_note = None
+            self.selected_note = autocompletable_match
 
     def on_search_box_changed(self, edit, new_edit_text):
         self.filter(new_edit_text)
@@ -339,7 +739,12 @@ class MainFrame(urwid.Frame):
         self.selected_note = note
 
 
-def launch(notes_dir, editor, extension, extensions, exclude=None):
+def launch(notes_dir, editor, extension, extensions, exclude=None,
+           cache_bytes=tv_notebook.DEFAULT_CACHE_BYTES,
+           max_note_size=tv_notebook.DEFAULT_MAX_NOTE_SIZE,
+           search_engine='brute', search_workers=None, index_cache=None,
+           search_delay=0.0,
+           show_stats=False, sort='mtime', match_mode='exact'):
     """Launch the user interface."""
     frame = MainFrame(
         notes_dir,
@@ -347,6 +752,16 @@ def launch(notes_dir, editor, extension, extensions, exclude=None):
         extension,
         extensions,
         exclude=exclude,
+        cache_bytes=cache_bytes,
+        max_note_size=max_note_size,
+        search_engine=search_engine,
+        search_workers=search_workers,
+        index_cache=index_cache,
+        search_delay=search_delay,
+        show_stats=show_stats,
+        sort=sort,
+        match_mode=match_mode,
+        load_in_background=True,
     )
     frame.loop = urwid.MainLoop(frame, palette)
     frame.loop.run()
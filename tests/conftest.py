@@ -0,0 +1,28 @@
+import os
+import sys
+import unicodedata
+
+# The modules aren't in a package, they're installed from src/.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+import tv_query  # noqa: E402
+
+
+class FakeNote(object):
+    """Just enough of a PlainTextNote for matching queries and snippets."""
+
+    is_large = False
+
+    def __init__(self, title, contents, abspath=None):
+        self.title = title
+        self.title_nfc = unicodedata.normalize('NFC', title)
+        self.title_key = tv_query.search_key(title)
+        self.contents = unicodedata.normalize('NFC', contents)
+        self.contents_key = tv_query.search_key(contents)
+        self.abspath = abspath or '/notes/' + title + '.txt'
+
+    def contains(self, search_word):
+        if search_word.islower():
+            return search_word in self.contents_key
+        return search_word in self.contents
+
@@ -0,0 +1,88 @@
+"""Tests for searching several notes directories together."""
+
+import os
+import time
+
+import pytest
+
+import tv_index
+import tv_notebook
+
+
+def write(path, text, mtime):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fp:
+        fp.write(text)
+    os.utime(path, (mtime, mtime))
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+@pytest.fixture
+def roots(tmp_path):
+    work = tmp_path / 'work'
+    personal = tmp_path / 'personal'
+    project = work / 'project'
+    for number, root in enumerate([work, personal, project]):
+        for index in range(3):
+            write(str(root / 'todo {}.txt'.format(index)),
+                  'meeting {} {}'.format(root.name, index),
+                  1000 + 10 * number + index)
+    return [str(work), str(personal), str(project)]
+
+
+def describe(notes):
+    return [(note.notebook.name, note.title) for note in notes]
+
+
+@pytest.mark.parametrize('search_engine', ['brute', 'index'])
+def test_notes_are_merged_newest_first(roots, search_engine):
+    # A root given twice, and one inside another, don't duplicate notes.
+    notebook = tv_notebook.make_notebook(
+        roots + [roots[1] + os.sep], 'txt', ['.txt'], watch=False,
+        search_function=tv_index.make_search_function(search_engine))
+    assert len(notebook) == 9
+    assert describe(notebook.search('meeting')) == [
+        ('project', 'todo 2'), ('project', 'todo 1'), ('project', 'todo 0'),
+        ('personal', 'todo 2'), ('personal', 'todo 1'),
+        ('personal', 'todo 0'),
+        ('work', 'todo 2'), ('work', 'todo 1'), ('work', 'todo 0'),
+    ]
+    assert describe(notebook.search('personal 1')) == [
+        ('personal', 'todo 1')]
+    assert notebook.complete_title('todo').notebook.name == 'project'
+
+
+def test_new_notes_go_in_the_first_root(roots):
+    notebook = tv_notebook.make_notebook(roots, 'txt', ['.txt'], watch=False)
+    note = notebook.add_new('fresh.txt')
+    assert os.path.dirname(note.abspath) == roots[0]
+    assert describe(notebook.search('fresh')) == [('work', 'fresh')]
+    notebook.remove(note.filename)
+    assert notebook.search('fresh') == []
+
+
+def test_search_function_is_attached_before_watching(roots):
+    class CheckingSearch(tv_index.IndexedSearch):
+        def attach(self, notebook):
+            assert all(root._observer is None for root in notebook.notebooks)
+            super(CheckingSearch, self).attach(notebook)
+
+    notebook = tv_notebook.make_notebook(
+        roots, 'txt', ['.txt'], search_function=CheckingSearch(),
+        event_delay=0.01)
+    try:
+        write(os.path.join(roots[1], 'new.txt'), 'watched note', 2000)
+        assert wait_for(lambda: notebook.search('watched'))
+        assert describe(notebook.search('watched')) == [('personal', 'new')]
+        assert (notebook.search('watched')
+                == tv_notebook.brute_force_search(notebook, 'watched'))
+    finally:
+        notebook.stop_watching()
@@ -0,0 +1,132 @@
+"""Tests for compiling and matching queries."""
+
+import random
+
+import pytest
+
+import tv_notebook
+import tv_query
+from conftest import FakeNote
+
+
+CHARACTERS = 'abAB sßSéé'
+WORDS = ['a', 'ab', 'abb', 'Ab', 'AB', 'bA', 'ss', 'SS', 'ß',
+         'Straße', 'strasse', 'café', 'café', 'Café']
+
+
+def random_text(rng, length):
+    return ''.join(rng.choice(CHARACTERS) for _ in range(length))
+
+
+def random_term(rng):
+    word = rng.choice(WORDS + [random_text(rng, rng.randint(1, 3)).strip()
+                               or 'a'])
+    kind = rng.random()
+    if kind < 0.15:
+        term = 'title:' + word
+    elif kind < 0.25:
+        term = 're:' + word
+    elif kind < 0.4:
+        term = '"{} {}"'.format(word, rng.choice(WORDS))
+    else:
+        term = word
+    if rng.random() < 0.2:
+        term = '-' + term
+    return term
+
+
+def random_query(rng):
+    terms = [random_term(rng) for _ in range(rng.randint(1, 3))]
+    if len(terms) > 1 and rng.random() < 0.3:
+        terms.insert(1, 'OR')
+    return ' '.join(terms)
+
+
+def refine(rng, query):
+    """Return a query typed on from `query`, which often implies it."""
+    choice = rng.random()
+    if choice < 0.4:
+        return query + rng.choice('abAsßé')
+    if choice < 0.7:
+        return query + ' ' + random_term(rng)
+    return random_query(rng)
+
+
+@pytest.fixture(scope='module')
+def notes():
+    rng = random.Random(1)
+    return [FakeNote(random_text(rng, rng.randint(0, 6)),
+                     random_text(rng, rng.randint(0, 30)), '/notes/%d' % i)
+            for i in range(300)]
+
+
+def test_compile_query():
+    query = tv_query.compile_query(
+        're:x.z -old "two words" title:Plan a OR b')
+    kinds = [[(term.kind, term.text, term.negated) for term in clause]
+             for clause in query.clauses]
+    assert kinds == [
+        [('title', 'Plan', False)],
+        [('word', 'old', True)],
+        [('word', 'two words', False)],
+        [('word', 'a', False), ('word', 'b', False)],
+        [('regex', 'x.z', False)],
+    ]
+    assert query.words == ['Plan', 'two words', 'a', 'b']
+    assert tv_query.compile_query('  ').clauses == []
+
+
+def test_large_notes_are_searched_without_caching(tmp_path):
+    (tmp_path / 'big.txt').write_text('line of log\n' * 100 + 'Café 42\n')
+    (tmp_path / 'small.txt').write_text('Café 7')
+    notebook = tv_notebook.PlainTextNoteBook(
+        str(tmp_path), 'txt', ['.txt'], max_note_size=100, watch=False)
+    titles = [note.title for note in notebook.search(r're:café.\d+')]
+    assert sorted(titles) == ['big', 'small']
+    assert [note.title for note in notebook.search('re:Café.42')] == ['big']
+    assert [note.title for note in notebook.search('caf')] == ['small', 'big']
+    assert len(notebook.content_cache) == 1
+
+
+@pytest.mark.parametrize('new, old', [
+    ('abc', 'ab'),
+    ('Abc', 'ab'),
+    ('a b', 'a'),
+    ('"a b"', 'a'),
+    ('title:ab', 'a'),
+    ('-a', '-ab'),
+    ('a', 'a OR b'),
+    ('Straße', 'ss'),
+])
+def test_implies(new, old):
+    assert tv_query.compile_query(new).implies(tv_query.compile_query(old))
+
+
+@pytest.mark.parametrize('new, old', [
+    ('ab', 'abc'),
+    ('ab', 'Ab'),
+    ('a OR b', 'a'),
+    ('-ab', '-a'),
+    ('re:ab', 'ab'),
+])
+def test_doesnt_imply(new, old):
+    assert not tv_query.compile_query(new).implies(
+        tv_query.compile_query(old))
+
+
+def test_implies_is_sound(notes):
+    rng = random.Random(2)
+    implied = 0
+    for _ in range(3000):
+        old = random_query(rng)
+        new = refine(rng, old)
+        old_query = tv_query.compile_query(old)
+        new_query = tv_query.compile_query(new)
+        if not new_query.implies(old_query):
+            continue
+        implied += 1
+        for note in notes:
+            if new_query.matches(note):
+                assert old_query.matches(note), (new, old, note.title,
+                                                 note.contents)
+    assert implied > 500
@@ -0,0 +1,39 @@
+"""Tests for matching by Unicode search keys and mapping matches back."""
+
+import unicodedata
+
+import pytest
+
+import tv_notebook
+import tv_query
+from conftest import FakeNote
+
+
+def test_smart_case_and_unicode_keys():
+    note = FakeNote('Straße', 'Café au lait')
+    assert tv_query.compile_query('strasse').matches(note)
+    assert tv_query.compile_query('STRASSE').matches(note) is False
+    assert tv_query.compile_query('café').matches(note)
+    assert tv_query.compile_query('Café').matches(note)
+    decomposed = FakeNote(unicodedata.normalize('NFD', 'Café notes'), '')
+    assert tv_query.compile_query('Café').matches(decomposed)
+    assert tv_query.compile_query('title:Café').matches(decomposed)
+
+
+@pytest.mark.parametrize('contents, word, matched', [
+    ('Die Straße ist lang', 'strasse', 'Straße'),
+    ('Die Straße ist lang', 'ss', 'ß'),
+    ('Groß und Straße', 'strasse', 'Straße'),
+    ('A ﬁne ﬁsh', 'fish', 'ﬁsh'),
+    ('A ﬁne ﬁsh', 'ne', 'ne'),
+    ('ﬁ and fi', 'fi', 'ﬁ'),
+])
+def test_match_offsets_map_back_to_contents(contents, word, matched):
+    note = FakeNote('note', contents)
+    offsets = tv_notebook.match_offsets(note, [word])
+    assert offsets
+    start, end = offsets[0]
+    assert contents[start:end] == matched
+    text, highlights = tv_notebook.snippet(note, [word])
+    start, end = highlights[0]
+    assert text[start:end] == matched
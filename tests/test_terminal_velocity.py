@@ -0,0 +1,92 @@
+"""Tests for searching from the command line without the interface."""
+
+import io
+import json
+import os
+
+import pytest
+
+import terminal_velocity
+import tv_index
+import tv_notebook
+
+
+@pytest.fixture
+def notes_dir(tmp_path):
+    notes = tmp_path / 'notes'
+    notes.mkdir()
+    for mtime, (name, text) in enumerate([
+            ('old plan', 'meeting plan plan plan'),
+            ('agenda', 'meeting agenda'),
+            ('shopping', 'milk and eggs'),
+            ('new plan', 'meeting plan')]):
+        path = notes / (name + '.txt')
+        path.write_text(text)
+        os.utime(str(path), (1000 + mtime, 1000 + mtime))
+    return notes
+
+
+def print_matches(notes_dir, query, **kwargs):
+    out = io.StringIO()
+    terminal_velocity.print_matches(
+        str(notes_dir), query, 'txt', ['.txt'], out=out, **kwargs)
+    return out.getvalue().splitlines()
+
+
+def names(lines):
+    return [os.path.basename(line) for line in lines]
+
+
+def test_matches_are_printed_newest_first(notes_dir):
+    assert names(print_matches(notes_dir, 'meeting')) == [
+        'new plan.txt', 'agenda.txt', 'old plan.txt']
+    assert names(print_matches(notes_dir, 'meeting', limit=2)) == [
+        'new plan.txt', 'agenda.txt']
+    assert print_matches(notes_dir, 'nothing') == []
+
+
+def test_empty_query_lists_every_note(notes_dir):
+    assert names(print_matches(notes_dir, '  ')) == [
+        'new plan.txt', 'shopping.txt', 'agenda.txt', 'old plan.txt']
+
+
+def test_relevance_and_json_lines(notes_dir):
+    lines = print_matches(notes_dir, 'plan', sort='relevance',
+                          json_lines=True)
+    fields = [json.loads(line) for line in lines]
+    assert [field['title'] for field in fields] == ['old plan', 'new plan']
+    assert fields[0] == {'path': str(notes_dir / 'old plan.txt'),
+                         'title': 'old plan', 'mtime': 1000.0}
+
+
+def test_several_notes_directories(notes_dir, tmp_path):
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'minutes.txt').write_text('meeting minutes')
+    out = io.StringIO()
+    terminal_velocity.print_matches(
+        [str(notes_dir), str(other)], 'minutes', 'txt', ['.txt'],
+        json_lines=True, out=out)
+    fields = json.loads(out.getvalue())
+    assert (fields['title'], fields['root']) == ('minutes', 'other')
+
+
+def test_index_is_only_used_when_warm(notes_dir, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    assert names(print_matches(
+        notes_dir, 'meeting', search_engine='index',
+        index_cache=cache_dir)) == [
+            'new plan.txt', 'agenda.txt', 'old plan.txt']
+    search = tv_index.IndexedSearch(cache_dir=cache_dir)
+    assert not search.is_warm(str(notes_dir))
+
+    # An index stored by an earlier run is used, and kept up to date.
+    search = tv_index.make_search_function('index', cache_dir=cache_dir)
+    tv_notebook.PlainTextNoteBook(
+        str(notes_dir), 'txt', ['.txt'], search_function=search, watch=False)
+    search.close()
+    (notes_dir / 'minutes.txt').write_text('meeting minutes')
+    assert names(print_matches(
+        notes_dir, 'minutes', search_engine='index',
+        index_cache=cache_dir)) == ['minutes.txt']
+    assert search.is_warm(str(notes_dir))
@@ -0,0 +1,42 @@
+"""Tests for completing titles from the title index."""
+
+import random
+
+import tv_notebook
+import tv_query
+from conftest import FakeNote
+
+
+CHARACTERS = 'abAB sßSéé'
+
+
+def random_text(rng, length):
+    return ''.join(rng.choice(CHARACTERS) for _ in range(length))
+
+
+def test_title_index_matches_linear_scan():
+    rng = random.Random(3)
+    index = tv_notebook.TitleIndex()
+    keys = {}
+    for step in range(2000):
+        action = rng.random()
+        if action < 0.5 or not keys:
+            note = FakeNote(random_text(rng, rng.randint(0, 4)), '',
+                            '/notes/%d' % step)
+            key = (rng.randint(0, 50), note.abspath)
+            index.add(note, key)
+            keys[note.abspath] = (note, key)
+        elif action < 0.7:
+            note, _ = keys.pop(rng.choice(sorted(keys)))
+            index.remove(note)
+        else:
+            note, _ = keys[rng.choice(sorted(keys))]
+            key = (rng.randint(0, 50), note.abspath)
+            index.update(note, key)
+            keys[note.abspath] = (note, key)
+        prefix = random_text(rng, rng.randint(0, 2))
+        prefix_key = tv_query.search_key(prefix)
+        expected = sorted(key for note, key in keys.values()
+                          if note.title_key.startswith(prefix_key))
+        assert index.first(prefix) == (expected[0] if expected else None)
+        assert list(index.newest(prefix)) == expected
@@ -0,0 +1,50 @@
+"""Tests for fuzzy matching within lines."""
+
+import random
+import re
+import time
+
+import tv_fuzzy
+import tv_notebook
+from conftest import FakeNote
+
+
+def test_line_subsequence_matches_lazy_regex():
+    rng = random.Random(4)
+    for _ in range(5000):
+        text = ''.join(rng.choice('ab\nc') for _ in range(rng.randint(0, 12)))
+        word = ''.join(rng.choice('abc') for _ in range(rng.randint(1, 3)))
+        match = re.search('[^\n]*?'.join(word), text)
+        offsets = tv_notebook.line_subsequence(text, word)
+        if match is None:
+            assert offsets is None, (text, word)
+        else:
+            assert offsets[0] == match.start(), (text, word)
+            assert offsets[-1] == match.end() - 1, (text, word)
+            assert [text[offset] for offset in offsets] == list(word)
+
+
+def test_long_line_missing_a_character_is_linear():
+    # One long line with all but the last character of the word, and the
+    # last character on another line, used to backtrack for minutes.
+    line = 'ab' * 200000
+    note = FakeNote('note', line + '\nc\n')
+    start = time.perf_counter()
+    assert tv_fuzzy.FuzzySearch()([note], 'abc') == []
+    assert tv_fuzzy.FuzzySearch.match_offsets(note, ['abc']) == []
+    assert time.perf_counter() - start < 1
+    assert tv_fuzzy.FuzzySearch()([note], 'abab') == [note]
+
+
+def test_scan_file_lines(tmp_path, monkeypatch):
+    # Small chunks, so that lines are split across chunk boundaries.
+    monkeypatch.setattr(tv_notebook, 'SCAN_CHUNK_BYTES', 16)
+    path = tmp_path / 'large.txt'
+    path.write_text('x' * 40 + '\n' + 'A' + 'y' * 30 + 'B' + 'z' * 30 + 'C\n'
+                    + 'ab' * 1000 + '\nStraße\n', encoding='utf-8')
+    assert tv_notebook.scan_file(str(path), 'abc', lines=True)
+    assert tv_notebook.scan_file(str(path), 'ABC', lines=True)
+    assert not tv_notebook.scan_file(str(path), 'xa', lines=True)
+    assert not tv_notebook.scan_file(str(path), 'bx', lines=True)
+    assert tv_notebook.scan_file(str(path), 'sse', lines=True)
+    assert not tv_notebook.scan_file(str(path), 'ABA', lines=True)
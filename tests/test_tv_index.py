@@ -0,0 +1,117 @@
+"""Tests for the trigram index and its store."""
+
+import os
+
+import pytest
+
+import tv_index
+import tv_notebook
+
+
+class CountingSearch(tv_index.IndexedSearch):
+    """Records the notes that were read while attaching."""
+
+    def __init__(self, cache_dir):
+        super().__init__(cache_dir=cache_dir)
+        self.read = []
+
+    def _index_note(self, note, signature=None):
+        self.read.append(note.title)
+        super()._index_note(note, signature)
+
+
+def write(path, text, mtime=1000):
+    with open(path, 'w') as fp:
+        fp.write(text)
+    os.utime(path, (mtime, mtime))
+
+
+def load(path, cache_dir):
+    search = CountingSearch(str(cache_dir))
+    notebook = tv_notebook.PlainTextNoteBook(
+        str(path), 'txt', ['.txt'], search_function=search, watch=False)
+    return notebook, search
+
+
+def titles(notes):
+    return sorted(note.title for note in notes)
+
+
+@pytest.fixture
+def notes(tmp_path):
+    path = tmp_path / 'notes'
+    path.mkdir()
+    for index in range(5):
+        write(str(path / 'note {}.txt'.format(index)),
+              'apple {} banana'.format(index))
+    return path
+
+
+def test_warm_start_reads_no_notes(notes, tmp_path):
+    cache_dir = tmp_path / 'cache'
+    notebook, search = load(notes, cache_dir)
+    assert len(search.read) == 5
+    search.close()
+    assert search.is_warm(str(notes))
+
+    notebook, search = load(notes, cache_dir)
+    assert search.read == []
+    assert titles(notebook.search('banana')) == [
+        'note 0', 'note 1', 'note 2', 'note 3', 'note 4']
+    assert titles(notebook.search('apple 3')) == ['note 3']
+    search.close()
+
+
+def test_changed_deleted_and_new_notes_are_reconciled(notes, tmp_path):
+    cache_dir = tmp_path / 'cache'
+    notebook, search = load(notes, cache_dir)
+    search.close()
+
+    write(str(notes / 'note 1.txt'), 'cherry', mtime=2000)
+    os.remove(str(notes / 'note 2.txt'))
+    write(str(notes / 'note 5.txt'), 'apple 5 cherry')
+
+    notebook, search = load(notes, cache_dir)
+    assert sorted(search.read) == ['note 1', 'note 5']
+    assert titles(notebook.search('banana')) == ['note 0', 'note 3', 'note 4']
+    assert titles(notebook.search('cherry')) == ['note 1', 'note 5']
+    assert titles(notebook.search('apple')) == [
+        'note 0', 'note 3', 'note 4', 'note 5']
+    search.close()
+
+    # The reconciled index was stored on close.
+    notebook, search = load(notes, cache_dir)
+    assert search.read == []
+    assert titles(notebook.search('cherry')) == ['note 1', 'note 5']
+    assert titles(notebook.search('banana')) == ['note 0', 'note 3', 'note 4']
+    search.close()
+
+
+def test_note_with_undecodable_filename_is_stored(notes, tmp_path):
+    cache_dir = tmp_path / 'cache'
+    with open(os.path.join(os.fsencode(str(notes)), b'caf\xe9.txt'),
+              'wb') as fp:
+        fp.write(b'espresso')
+
+    notebook, search = load(notes, cache_dir)
+    assert titles(notebook.search('espresso')) == ['caf\udce9']
+    search.close()
+
+    notebook, search = load(notes, cache_dir)
+    assert search.read == []
+    assert titles(notebook.search('espresso')) == ['caf\udce9']
+    search.close()
+
+
+def test_removed_documents_are_compacted():
+    index = tv_index.TrigramIndex()
+    index.MIN_COMPACT = 2
+    for number in range(4):
+        index.add_trigrams('n{}'.format(number), {'abc', 'bcd'})
+    index.remove('n0')
+    index.remove('n1')
+    index.add_trigrams('n2', {'xyz'})
+    assert index.candidates('abcd') == {'n3'}
+    assert index.candidates('xyz') == {'n2'}
+    keys, postings = index.snapshot(lambda key: True)
+    assert sorted(keys) == ['n2', 'n3']
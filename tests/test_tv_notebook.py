@@ -0,0 +1,160 @@
+"""Tests for notebooks, their caches and their file events."""
+
+import os
+import time
+
+import tv_notebook
+import tv_query
+
+
+def load(path, **kwargs):
+    return tv_notebook.PlainTextNoteBook(
+        str(path), 'txt', ['.txt'], watch=False, **kwargs)
+
+
+def test_cached_contents_are_validated_without_stat(tmp_path, monkeypatch):
+    (tmp_path / 'note.txt').write_text('Café')
+    notebook = load(tmp_path)
+    note = notebook.get('note.txt')
+    assert note.contents == 'Café'
+    assert note.contents_key == tv_query.search_key('Café')
+
+    stats = []
+    real_stat = os.stat
+
+    def counting_stat(path, *args, **kwargs):
+        stats.append(path)
+        return real_stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, 'stat', counting_stat)
+    for _ in range(3):
+        assert note.contents == 'Café'
+        assert note.contents_key == tv_query.search_key('Café')
+    assert stats == []
+    assert notebook.content_cache.misses == 1
+
+    # Without a signature the file is stat'ed, and a changed one is read.
+    cache = notebook.content_cache
+    assert cache.get(note.abspath)[0] == 'Café'
+    assert stats == [note.abspath]
+    with open(note.abspath, 'w') as fp:
+        fp.write('Tea and cake')
+    notebook.update('note.txt')
+    assert note.contents == 'Tea and cake'
+    assert cache.misses == 2
+
+
+class Event(object):
+    """Stands in for a watchdog event."""
+
+    def __init__(self, event_type, src_path, dest_path=None,
+                 is_directory=False):
+        self.event_type = event_type
+        self.src_path = src_path
+        self.dest_path = dest_path
+        self.is_directory = is_directory
+
+
+class Recorder(object):
+    """A notebook listener that records its calls."""
+
+    def __init__(self):
+        self.calls = []
+
+    def note_added(self, note):
+        self.calls.append(('added', note.title))
+
+    def note_removed(self, note):
+        self.calls.append(('removed', note.title))
+
+    def note_changed(self, note):
+        self.calls.append(('changed', note.title))
+
+    def notes_changed(self):
+        self.calls.append(('notes_changed',))
+
+
+def test_a_burst_of_events_is_applied_once(tmp_path):
+    for name in ['edited', 'renamed', 'deleted', 'kept']:
+        (tmp_path / (name + '.txt')).write_text(name)
+    notebook = load(tmp_path)
+    recorder = Recorder()
+    notebook.add_listener(recorder)
+    handler = tv_notebook.FileEventHandler(notebook, delay=60)
+
+    path = str(tmp_path)
+    with open(os.path.join(path, 'edited.txt'), 'a') as fp:
+        fp.write(' twice')
+    os.rename(os.path.join(path, 'renamed.txt'),
+              os.path.join(path, 'moved.txt'))
+    os.remove(os.path.join(path, 'deleted.txt'))
+    (tmp_path / 'created.txt').write_text('created')
+    for event in [
+            Event('modified', os.path.join(path, 'edited.txt')),
+            Event('modified', os.path.join(path, 'edited.txt')),
+            Event('moved', os.path.join(path, 'renamed.txt'),
+                  os.path.join(path, 'moved.txt')),
+            Event('deleted', os.path.join(path, 'deleted.txt')),
+            Event('created', os.path.join(path, 'created.txt')),
+            Event('modified', os.path.join(path, 'created.txt')),
+            Event('modified', os.path.join(path, 'kept.txt')),
+            Event('modified', path, is_directory=True),
+            Event('opened', os.path.join(path, 'kept.txt'))]:
+        handler.dispatch(event)
+    assert recorder.calls == []
+
+    handler.flush()
+    assert sorted(recorder.calls[:-1]) == [
+        ('added', 'created'), ('added', 'moved'), ('changed', 'edited'),
+        ('removed', 'deleted'), ('removed', 'renamed')]
+    assert recorder.calls[-1] == ('notes_changed',)
+    assert sorted(note.title for note in notebook) == [
+        'created', 'edited', 'kept', 'moved']
+    assert [note.title for note in notebook.search('twice')] == ['edited']
+
+    # Nothing is queued after a flush, and cancelled events are dropped.
+    handler.flush()
+    handler.dispatch(Event('deleted', os.path.join(path, 'kept.txt')))
+    handler.cancel()
+    handler.flush()
+    assert len(recorder.calls) == 6
+
+
+def test_events_are_flushed_after_the_delay(tmp_path):
+    notebook = load(tmp_path)
+    recorder = Recorder()
+    notebook.add_listener(recorder)
+    handler = tv_notebook.FileEventHandler(notebook, delay=0.05)
+    for index in range(20):
+        path = tmp_path / 'note {}.txt'.format(index)
+        path.write_text('burst')
+        handler.dispatch(Event('created', str(path)))
+    deadline = time.time() + 5
+    while ('notes_changed',) not in recorder.calls:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    assert recorder.calls.count(('notes_changed',)) == 1
+    assert len(notebook.search('burst')) == 20
+
+
+def test_directory_changes_are_rescanned(tmp_path):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'a' / 'one.txt').write_text('one')
+    (tmp_path / 'a' / 'two.txt').write_text('two')
+    notebook = load(tmp_path)
+    recorder = Recorder()
+    notebook.add_listener(recorder)
+
+    os.rename(str(tmp_path / 'a'), str(tmp_path / 'b'))
+    assert notebook.apply_changes(
+        {str(tmp_path / 'a'): True, str(tmp_path / 'b'): True})
+    assert sorted(note.title for note in notebook) == ['b/one', 'b/two']
+    assert sorted(recorder.calls) == [
+        ('added', 'b/one'), ('added', 'b/two'), ('notes_changed',),
+        ('removed', 'a/one'), ('removed', 'a/two')]
+
+    # Paths that haven't changed on disk don't notify anyone.
+    del recorder.calls[:]
+    assert not notebook.apply_changes({str(tmp_path / 'b' / 'one.txt'): False,
+                                       str(tmp_path / 'missing.txt'): False})
+    assert recorder.calls == []
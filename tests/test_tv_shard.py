@@ -0,0 +1,72 @@
+"""Tests for searching across worker processes."""
+
+import pytest
+
+import tv_notebook
+import tv_shard
+
+
+QUERIES = ['meeting', 'Meeting', 'straße', 'strasse', '"budget plan"',
+           'meeting -budget', 'title:idea', 're:pl.n', 'idea OR café',
+           'zzz', 'needle']
+
+
+@pytest.fixture
+def notes_dir(tmp_path):
+    words = ['meeting', 'Meeting', 'budget plan', 'Straße', 'café', 'idea']
+    for index in range(40):
+        text = ' '.join(words[(index + step) % len(words)]
+                        for step in range(index % 4))
+        (tmp_path / 'note {}.txt'.format(index)).write_text(text)
+    (tmp_path / 'idea log.txt').write_text('x' * 200 + ' needle meeting')
+    return tmp_path
+
+
+def load(path, search_function=tv_notebook.brute_force_search):
+    return tv_notebook.PlainTextNoteBook(
+        str(path), 'txt', ['.txt'], search_function=search_function,
+        max_note_size=100, watch=False)
+
+
+def titles(notes):
+    return [note.title for note in notes]
+
+
+@pytest.fixture
+def sharded(notes_dir):
+    search = tv_shard.ShardedSearch(workers=3)
+    notebook = load(notes_dir, search)
+    yield notebook, search
+    search.close()
+
+
+def test_matches_brute_force_search(notes_dir, sharded):
+    notebook, _ = sharded
+    brute = load(notes_dir)
+    for query in QUERIES:
+        assert titles(notebook.search(query)) == titles(brute.search(query)), (
+            query)
+    assert titles(notebook.search('needle')) == ['idea log']
+
+
+def test_changes_are_sent_to_the_workers(notes_dir, sharded):
+    notebook, _ = sharded
+    (notes_dir / 'new.txt').write_text('unusual words')
+    (notes_dir / 'note 1.txt').write_text('unusual too')
+    (notes_dir / 'note 2.txt').unlink()
+    notebook.apply_changes({str(notes_dir / name): False for name in [
+        'new.txt', 'note 1.txt', 'note 2.txt']})
+    assert sorted(titles(notebook.search('unusual'))) == ['new', 'note 1']
+    assert 'note 2' not in titles(notebook.search('meeting'))
+
+
+def test_falls_back_to_brute_force_without_workers(notes_dir, sharded):
+    notebook, search = sharded
+    expected = titles(notebook.search('meeting'))
+    search._processes[0].terminate()
+    search._processes[0].join()
+    assert titles(notebook.search('meeting budget')) == titles(
+        load(notes_dir).search('meeting budget'))
+    assert search._connections == []
+    search.close()
+    assert titles(notebook.search('meeting')) == expected
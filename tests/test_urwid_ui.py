@@ -0,0 +1,41 @@
+"""Tests for the interface's main frame."""
+
+import pytest
+
+import urwid_ui
+
+
+@pytest.fixture
+def frame(tmp_path):
+    for index, text in enumerate(['apple', 'apple apple', 'pear']):
+        (tmp_path / 'note {}.txt'.format(index)).write_text(text)
+    frame = urwid_ui.MainFrame(
+        str(tmp_path), 'true', 'txt', ['.txt'], sort='relevance')
+    # Notes are only changed by the tests.
+    frame.tv_notebook.stop_watching()
+    yield frame
+    frame._search_executor.shutdown()
+
+
+def test_ranked_results_are_cached_until_a_note_changes(frame, tmp_path):
+    ranked = frame.search('apple')
+    assert [note.title for note in ranked] == ['note 1', 'note 0']
+    assert frame.search('apple') is ranked
+
+    (tmp_path / 'note 2.txt').write_text('apple apple apple')
+    frame.tv_notebook.update('note 2.txt')
+    ranked = frame.search('apple')
+    assert [note.title for note in ranked] == ['note 2', 'note 1', 'note 0']
+    assert frame.search('apple') is ranked
+
+
+def test_stats_line_is_current_when_rendered(tmp_path):
+    (tmp_path / 'note.txt').write_text('apple')
+    frame = urwid_ui.MainFrame(
+        str(tmp_path), 'true', 'txt', ['.txt'], show_stats=True)
+    frame.tv_notebook.stop_watching()
+    frame.keypress((80, 10), 'a')
+    canvas = frame.render((80, 10))
+    shown = b'\n'.join(canvas.text).decode()
+    assert '{} matches'.format(len(frame.list_box.list_walker)) in shown
+    frame._search_executor.shutdown()